@@ -0,0 +1,63 @@
+import io
+import itertools
+import logging
+import timeit
+
+from common.logs import RequestLog
+
+# A statement of a realistic size, logged as is by the former per-request log line
+SQL = "SELECT f.title, f.description FROM film f JOIN film_actor fa ON f.film_id = fa.film_id " \
+      "WHERE fa.actor_id = {} AND f.rental_rate > 0.99 ORDER BY f.title LIMIT 50"
+
+ROUNDS = 100000
+
+
+def bench(name: str, fn):
+    seconds = min(timeit.repeat(fn, number=ROUNDS, repeat=5))
+    print(f"{name:<44} {seconds / ROUNDS * 1e6:8.2f} µs/request")
+
+
+def main():
+    """
+    Measure the per-request cost of logging, as seen by the thread serving the request
+    """
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    for name in ("bench.inline", "bench.requests"):
+        logger = logging.getLogger(name)
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+    counter = itertools.count()
+    inline = logging.getLogger("bench.inline")
+
+    def log_inline():
+        # What every request used to cost: formatting the whole statement and writing it right away
+        sql = SQL.format(next(counter))
+        inline.info(f"Sending SQL command '{sql}' to host '10.0.0.12'")
+
+    def record(requests: RequestLog, seconds: float):
+        def run():
+            requests.record(seconds, route="custom", host="10.0.0.12", sql=SQL.format(next(counter)))
+        return run
+
+    def bench_log(name: str, requests: RequestLog, seconds: float):
+        # The writer runs meanwhile, and competes with the requests for the interpreter
+        requests.start()
+        bench(name, record(requests, seconds))
+        requests.stop()
+
+    bench("synchronous log line", log_inline)
+    bench_log("request log, 1% sampled", RequestLog("bench.requests", sample_rate=0.01, slow_ms=100), 0.002)
+    every = RequestLog("bench.requests", sample_rate=1.0, slow_ms=100, queue_size=ROUNDS * 10)
+    bench_log("request log, every request", every, 0.002)
+    slow_only = RequestLog("bench.requests", slow_ms=100, slow_only=True)
+    bench_log("request log, slow only, fast request", slow_only, 0.002)
+    bench_log("request log, slow only, slow request", slow_only, 0.2)
+    print(every.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from common.sql import fingerprint
+
+# Share of the requests logged, from 0 to 1
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.01"))
+# Requests slower than this are always logged, and with LOG_SLOW_ONLY, they are the only ones logged
+LOG_SLOW_MS = float(os.environ.get("LOG_SLOW_MS", "100"))
+LOG_SLOW_ONLY = os.environ.get("LOG_SLOW_ONLY", "0") == "1"
+# Records waiting to be written, the oldest ones are dropped past this
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+# Seconds between two writes of the waiting records
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "0.1"))
+
+
+class RequestLog:
+    """
+    Structured records of the requests served, written as JSON lines by a background thread.
+
+    Recording a request only takes a sampling decision and, for the sampled ones, appending a tuple to a bounded
+    queue. Formatting, fingerprinting the SQL and the handler I/O all happen in the background thread.
+    """
+
+    def __init__(self, name: str, sample_rate: float = LOG_SAMPLE_RATE, slow_ms: float = LOG_SLOW_MS,
+                 slow_only: bool = LOG_SLOW_ONLY, queue_size: int = LOG_QUEUE_SIZE,
+                 flush_interval: float = LOG_FLUSH_INTERVAL):
+        self.logger = logging.getLogger(name)
+        self.sample_rate = 0.0 if slow_only else sample_rate
+        self.slow = slow_ms / 1000
+        self.flush_interval = flush_interval
+
+        self._queue: deque[tuple[float, float, bool, dict]] = deque(maxlen=queue_size)
+        self._dropped = 0
+        self._written = 0
+        self._writer: threading.Thread | None = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, error: bool = False, **fields):
+        """
+        Log the request if it was slow, failed, or was sampled. A "sql" field is logged as its fingerprint.
+        """
+        if seconds < self.slow and not error and random.random() >= self.sample_rate:
+            return
+        if len(self._queue) == self._queue.maxlen:
+            # Counted without a lock, this is only an estimate
+            self._dropped += 1
+        self._queue.append((time.time(), seconds, error, fields))
+
+    def start(self):
+        with self._lock:
+            if self._writer is not None:
+                return
+            self._stop.clear()
+            self._writer = threading.Thread(target=self._write_loop, daemon=True, name=f"{self.logger.name}-writer")
+            self._writer.start()
+
+    def stop(self):
+        """
+        Write the records still waiting, and stop the background thread
+        """
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._stop.set()
+            writer.join()
+
+    def stats(self) -> dict:
+        return {
+            "sample_rate": self.sample_rate,
+            "slow_ms": self.slow * 1000,
+            "waiting": len(self._queue),
+            "written": self._written,
+            "dropped": self._dropped,
+        }
+
+    def _write_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self._flush()
+        self._flush()
+
+    def _flush(self):
+        while self._queue:
+            at, seconds, error, fields = self._queue.popleft()
+            entry = {"ts": round(at, 6), "ms": round(seconds * 1000, 3), "error": error}
+            for key, value in fields.items():
+                if key == "sql":
+                    entry["fingerprint"] = fingerprint(value) if value else ""
+                else:
+                    entry[key] = value
+            level = logging.WARNING if error or seconds >= self.slow else logging.INFO
+            try:
+                self.logger.log(level, json.dumps(entry, default=str))
+                self._written += 1
+            except Exception:
+                # A failing handler must not stop the writer
+                self._dropped += 1
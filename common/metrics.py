@@ -0,0 +1,125 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets in seconds, growing by 10% from 10µs to a bit over a minute
+BUCKETS = [1e-5 * 1.1 ** i for i in range(int(math.log(6e6, 1.1)) + 2)]
+
+PERCENTILES = (50, 95, 99)
+
+
+class Series:
+    __slots__ = ("count", "errors", "total", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def merge(self, other: 'Series'):
+        self.count += other.count
+        self.errors += other.errors
+        self.total += other.total
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+
+    def percentile(self, p: float) -> float | None:
+        if not self.count:
+            return None
+        rank = math.ceil(self.count * p / 100)
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return BUCKETS[min(i, len(BUCKETS) - 1)]
+        return BUCKETS[-1]
+
+
+class Metrics:
+    """
+    Request counters and latency histograms, labelled by arbitrary keyword arguments.
+
+    Every thread records into its own shard, so recording never takes a lock nor contends with other threads.
+    Shards are only merged when a snapshot is taken. Shards of finished threads are folded into a single one,
+    as servers spawning one thread per request would otherwise pile them up.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: list[tuple[threading.Thread, dict]] = []
+        self._retired: dict[tuple, Series] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float, error: bool = False, **labels):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._register()
+
+        key = (name, tuple(labels.items()))
+        series = shard.get(key)
+        if series is None:
+            series = shard[key] = Series()
+        series.count += 1
+        series.errors += error
+        series.total += seconds
+        series.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(name, time.perf_counter() - start, error=True, **labels)
+            raise
+        self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._retire()
+            merged = {key: self._copy(series) for key, series in self._retired.items()}
+            shards = [shard for _, shard in self._shards]
+
+        for shard in shards:
+            # Copying the items is atomic, the owning thread may keep recording meanwhile
+            for key, series in list(shard.items()):
+                merged.setdefault(key, Series()).merge(series)
+
+        out = {}
+        for (name, labels), series in sorted(merged.items(), key=lambda item: str(item[0])):
+            entry = dict(labels)
+            entry["count"] = series.count
+            entry["errors"] = series.errors
+            entry["mean_ms"] = series.total / series.count * 1000 if series.count else None
+            for p in PERCENTILES:
+                value = series.percentile(p)
+                entry[f"p{p}_ms"] = None if value is None else value * 1000
+            out.setdefault(name, []).append(entry)
+        return out
+
+    def _register(self) -> dict:
+        shard = self._local.shard = {}
+        with self._lock:
+            self._shards.append((threading.current_thread(), shard))
+            if len(self._shards) > 2 * threading.active_count():
+                self._retire()
+        return shard
+
+    def _retire(self):
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+                continue
+            for key, series in shard.items():
+                self._retired.setdefault(key, Series()).merge(series)
+        self._shards = alive
+
+    @staticmethod
+    def _copy(series: Series) -> Series:
+        copy = Series()
+        copy.merge(series)
+        return copy
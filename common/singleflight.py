@@ -0,0 +1,63 @@
+import threading
+from typing import Callable, Hashable
+
+
+class Call:
+    __slots__ = ("done", "value", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error: BaseException | None = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Share a single execution of a function between the callers asking for the same key at the same time.
+
+    The first caller runs the function, the ones arriving while it is running wait for it and get the same result,
+    or the same exception. Nothing is kept once the call completes, callers arriving afterwards start a new one.
+    """
+
+    def __init__(self):
+        self._calls: dict[Hashable, Call] = {}
+        self._lock = threading.Lock()
+        self._leaders = 0
+        self._merged = 0
+
+    def do(self, key: Hashable, fn: Callable, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+                self._leaders += 1
+            else:
+                call.waiters += 1
+                self._merged += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = fn(*args)
+            return call.value
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "calls": self._leaders,
+                "merged": self._merged,
+            }
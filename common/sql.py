@@ -0,0 +1,155 @@
+import re
+from functools import lru_cache
+
+READ = "read"
+WRITE = "write"
+
+# One alternative per kind of token, tried in order. Literals and comments are matched as a whole so that
+# keywords inside them are never mistaken for SQL. As for MySQL, "--" only starts a comment when followed by a
+# whitespace or control character, "1--1" being 1 minus -1.
+_TOKEN = re.compile(r"""
+      (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+    | (?P<ident>`(?:[^`]|``)*`)
+    | (?P<comment>--(?=[\s\x00-\x1f]|$)[^\n]*|\#[^\n]*|/\*.*?\*/)
+    | (?P<number>(?<![\w$.])(?:0x[0-9a-fA-F]+|\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)(?![\w$]))
+    | (?P<space>\s+)
+    | (?P<word>[\w$@]+)
+    | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+# Lists of placeholders, as found in IN (...) and multi-row VALUES, collapse into a single one
+_PLACEHOLDER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+_ROW_LIST = re.compile(r"(\(\?\+?\))(?:\s*,\s*\1)+")
+
+_READ_KEYWORDS = {"SELECT", "SHOW", "EXPLAIN", "DESCRIBE", "DESC", "HELP"}
+_WRITE_KEYWORDS = {"INSERT", "UPDATE", "DELETE", "REPLACE"}
+# EXPLAIN ANALYZE runs the statement it explains, which is what must be classified
+_EXPLAIN_ANALYZE = re.compile(r"^(?:EXPLAIN|DESCRIBE|DESC) ANALYZE (?:FORMAT ?= ?\w+ )?")
+_LOCKING_READ = re.compile(r"\bFOR\s+(?:UPDATE|SHARE)\b|\bLOCK\s+IN\s+SHARE\s+MODE\b|\bINTO\b")
+
+# Statements whose effect outlives them on the connection: the current database, session variables, user
+# variables, transactions, locks, prepared statements and temporary tables
+_SESSION_STATE = re.compile(
+    r"^(?:USE|SET|BEGIN|START TRANSACTION|SAVEPOINT|RELEASE SAVEPOINT|XA|LOCK|UNLOCK|PREPARE|EXECUTE|DEALLOCATE|"
+    r"HANDLER|(?:CREATE|DROP) TEMPORARY)\b|:=|\bINTO @|\bGET_LOCK ?\(")
+
+# Results of statements calling these functions, or reading variables, change from one execution to the next
+_NON_DETERMINISTIC = re.compile(
+    r"\b(?:RAND|NOW|SYSDATE|CURDATE|CURTIME|CURRENT_DATE|CURRENT_TIME|CURRENT_TIMESTAMP|UNIX_TIMESTAMP|UUID|"
+    r"UUID_SHORT|CONNECTION_ID|LAST_INSERT_ID|FOUND_ROWS|ROW_COUNT|SLEEP|GET_LOCK|RELEASE_LOCK)\b|@")
+
+_TABLE_NAME = r"(?:`(?:[^`]|``)+`|[\w$]+)(?:\.(?:`(?:[^`]|``)+`|[\w$]+))?"
+_TABLE_ALIAS = r"(?:\s+(?:AS\s+)?(?!(?:WHERE|ON|USING|SET|VALUES|VALUE|SELECT|PARTITION|NATURAL|LEFT|RIGHT|INNER|OUTER|CROSS|" \
+               r"STRAIGHT_JOIN|JOIN|GROUP|ORDER|HAVING|LIMIT|WINDOW|UNION|FOR|LOCK|USE|IGNORE|FORCE)\b)[\w$]+)?"
+# INTO is optional after INSERT and REPLACE, and TABLE after TRUNCATE and LOAD DATA ... INTO
+_TABLE_REF = re.compile(
+    r"(?:\b(?:FROM|JOIN|UPDATE|TABLE)|\bINTO(?:\s+TABLE)?|\bTRUNCATE(?:\s+TABLE)?"
+    r"|\b(?:INSERT|REPLACE)(?:\s+(?:LOW_PRIORITY|DELAYED|HIGH_PRIORITY|IGNORE)\b)*+(?!\s+INTO\b))"
+    rf"\s+({_TABLE_NAME}{_TABLE_ALIAS}(?:\s*,\s*{_TABLE_NAME}{_TABLE_ALIAS})*)")
+_TABLE_LIST_ITEM = re.compile(rf"({_TABLE_NAME}){_TABLE_ALIAS}")
+
+
+def normalize(sql: str) -> str:
+    """
+    Collapse whitespace and comments, keeping everything else untouched
+    """
+    return _rewrite(sql, fold=False)
+
+
+def fingerprint(sql: str) -> str:
+    """
+    Normalize the statement, fold its case and replace its literals with placeholders, so that statements of
+    the same shape share the same fingerprint
+    """
+    fp = _rewrite(sql, fold=True)
+    fp = _PLACEHOLDER_LIST.sub("?+", fp)
+    return _ROW_LIST.sub(r"\1", fp)
+
+
+def unresolved(sql: str) -> bool:
+    """
+    Tell whether the statement has a quote or comment left open, whose extent MySQL may not see the same way
+    """
+    for match in _TOKEN.finditer(sql):
+        if match.lastgroup == "other" and (match.group() in "'\"`" or sql.startswith("/*", match.start())):
+            return True
+    return False
+
+
+def classify(sql: str) -> str:
+    """
+    Tell whether the statement only reads data, or must be sent to the master node
+    """
+    return classify_fingerprint(fingerprint(sql))
+
+
+def tables(sql: str) -> frozenset[str]:
+    """
+    Names of the tables the statement refers to, lower-cased and without their database prefix
+    """
+    return tables_fingerprint(fingerprint(sql))
+
+
+@lru_cache(maxsize=4096)
+def tables_fingerprint(fp: str) -> frozenset[str]:
+    names = set()
+    for match in _TABLE_REF.finditer(fp):
+        for name in _TABLE_LIST_ITEM.findall(match.group(1)):
+            name = name.rsplit(".", 1)[-1].strip("`").replace("``", "`")
+            if name != "?":
+                names.add(name.lower())
+    return frozenset(names)
+
+
+@lru_cache(maxsize=4096)
+def classify_fingerprint(fp: str) -> str:
+    words = fp.lstrip("( ").split(None, 1)
+    if not words:
+        return READ
+
+    keyword = words[0]
+    explained = _EXPLAIN_ANALYZE.match(fp.lstrip("( "))
+    if explained:
+        return classify_fingerprint(fp.lstrip("( ")[explained.end():])
+    if keyword == "WITH":
+        # Common table expressions may precede a DML statement
+        if any(word in _WRITE_KEYWORDS for word in re.findall(r"\b[A-Z]+\b", fp)):
+            return WRITE
+        keyword = "SELECT"
+
+    if keyword not in _READ_KEYWORDS:
+        return WRITE
+    if keyword == "SELECT" and _LOCKING_READ.search(fp):
+        return WRITE
+    return READ
+
+
+def changes_session(fp: str) -> bool:
+    """
+    Tell whether the statement leaves state on the connection it runs on, which later statements would inherit
+    """
+    return bool(_SESSION_STATE.search(fp))
+
+
+def deterministic(fp: str) -> bool:
+    """
+    Tell whether running the statement twice in a row gives the same result, as long as no data changed
+    """
+    return not _NON_DETERMINISTIC.search(fp)
+
+
+def _rewrite(sql: str, fold: bool) -> str:
+    parts = []
+    for match in _TOKEN.finditer(sql):
+        kind = match.lastgroup
+        token = match.group()
+        if kind == "space" or kind == "comment":
+            if parts and parts[-1] != " ":
+                parts.append(" ")
+        elif fold and kind in ("string", "number"):
+            parts.append("?")
+        elif fold and kind == "word":
+            parts.append(token.upper())
+        else:
+            parts.append(token)
+    return "".join(parts).strip().rstrip(";").rstrip()
@@ -0,0 +1,37 @@
+import json
+
+
+def is_json(content_type: str | None) -> bool:
+    """
+    Whether the media type is JSON, as told by werkzeug: application/json or application/*+json, parameters aside
+    """
+    mimetype = (content_type or "").split(";", 1)[0].strip().lower()
+    return mimetype == "application/json" or (mimetype.startswith("application/") and mimetype.endswith("+json"))
+
+
+def parse_statement(body: bytes, content_type: str | None) -> tuple[str, tuple | None]:
+    """
+    Read the SQL command of a request, either raw SQL or a JSON object holding a statement template and the
+    list of its parameters.
+
+    The gatekeeper checks and the proxy runs the statement read from the same body, so both must read it through
+    here. Bodies which could be read differently, as a media type mentioning JSON without being JSON, are refused.
+    """
+    if not is_json(content_type):
+        if "json" in (content_type or "").lower():
+            raise ValueError(f"Unsupported media type '{content_type}', statements are sent as application/json")
+        try:
+            return body.decode(), None
+        except UnicodeDecodeError:
+            raise ValueError("Statement must be UTF-8 text")
+
+    try:
+        statement = json.loads(body)
+    except ValueError:
+        raise ValueError("Statement must be a JSON document")
+    if not isinstance(statement, dict) or not isinstance(statement.get("sql"), str):
+        raise ValueError("Statement must be an object with a 'sql' template")
+    params = statement.get("params", [])
+    if not isinstance(params, list) or not all(p is None or isinstance(p, (str, int, float)) for p in params):
+        raise ValueError("Parameters must be a list of scalar values")
+    return statement["sql"], tuple(params)
@@ -2,13 +2,17 @@ import asyncio
 import logging
 
 from deploy.setup import setup
+from deploy.ssh import SSH_POOL
 from rich.logging import RichHandler
 
 logger = logging.getLogger(__name__)
 
 
 async def main():
-    await setup()
+    try:
+        await setup()
+    finally:
+        SSH_POOL.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,249 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import tarfile
+import threading
+from dataclasses import dataclass
+
+import requests
+from paramiko.client import SSHClient
+
+logger = logging.getLogger(__name__)
+
+ARTIFACTS_DIR = ".artifacts"
+CHUNK_SIZE = 1024 * 1024
+# Upstream SHA-256 of the downloaded artifacts, those still null are pinned on their first download
+ARTIFACTS_LOCK = os.path.join(os.path.dirname(__file__), "artifacts.lock.json")
+
+
+class ChecksumError(RuntimeError):
+    pass
+
+
+@dataclass(frozen=True)
+class Artifact:
+    url: str
+    # Expected SHA-256 of the content, pinned on the first download if unset
+    sha256: str | None = None
+
+    @property
+    def filename(self) -> str:
+        return self.url.rsplit("/", 1)[-1]
+
+
+def load_pins(path: str = ARTIFACTS_LOCK) -> dict[str, str | None]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def pinned(url: str) -> Artifact:
+    return Artifact(url, PINS.get(url))
+
+
+PINS = load_pins()
+
+MYSQL_CLUSTER_URL = "https://dev.mysql.com/get/Downloads/MySQL-Cluster-7.6"
+
+MYSQL_CLUSTER_MANAGEMENT_SERVER = pinned(
+    f"{MYSQL_CLUSTER_URL}/mysql-cluster-community-management-server_7.6.6-1ubuntu18.04_amd64.deb")
+MYSQL_CLUSTER_DATA_NODE = pinned(
+    f"{MYSQL_CLUSTER_URL}/mysql-cluster-community-data-node_7.6.6-1ubuntu18.04_amd64.deb")
+MYSQL_CLUSTER_BUNDLE = pinned(f"{MYSQL_CLUSTER_URL}/mysql-cluster_7.6.6-1ubuntu18.04_amd64.deb-bundle.tar")
+SAKILA = pinned("https://downloads.mysql.com/docs/sakila-db.zip")
+
+UPSTREAM = [MYSQL_CLUSTER_MANAGEMENT_SERVER, MYSQL_CLUSTER_DATA_NODE, MYSQL_CLUSTER_BUNDLE, SAKILA]
+
+
+class ArtifactCache:
+    """
+    Files needed on the nodes, downloaded or built once on the deploy host, and stored under their SHA-256.
+
+    Downloads must match the hash pinned for them in the lock file. An artifact without one is pinned to the hash
+    of its first download, to be reviewed and committed, and must match it from then on. Pushing a file to a node is
+    skipped when the node already holds a copy with the same hash, so that re-running a deployment only transfers
+    what changed, and the copy is checked on the node after each upload.
+    """
+
+    def __init__(self, root: str = ARTIFACTS_DIR, lock: str = ARTIFACTS_LOCK):
+        self.root = root
+        self.lock = lock
+        self._index_path = os.path.join(root, "index.json")
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        # Hashes whose local copy was checked during this run, to only read each file once
+        self._verified: set[str] = set()
+        try:
+            with open(self._index_path) as f:
+                self._index: dict[str, str] = json.load(f)
+        except FileNotFoundError:
+            self._index = {}
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, "sha256", digest)
+
+    def fetch(self, artifact: Artifact) -> str:
+        """
+        Download the artifact unless a verified copy is cached, and return its hash
+        """
+        with self._key_lock(artifact.url):
+            expected = artifact.sha256 or PINS.get(artifact.url)
+            digest = self._index.get(artifact.url)
+            if digest is not None and (expected is None or digest == expected) and self._valid(digest):
+                return digest
+
+            logger.info(f"Downloading {artifact.url}")
+            self._make_root()
+            tmp = os.path.join(self.root, f".{artifact.filename}.part")
+            sha = hashlib.sha256()
+            with requests.get(artifact.url, stream=True, timeout=60) as res, open(tmp, "wb") as f:
+                res.raise_for_status()
+                for chunk in res.iter_content(CHUNK_SIZE):
+                    sha.update(chunk)
+                    f.write(chunk)
+
+            digest = sha.hexdigest()
+            if expected is not None and digest != expected:
+                os.remove(tmp)
+                raise ChecksumError(f"{artifact.url} has hash {digest}, expected {expected}")
+            os.replace(tmp, self.path(digest))
+            self._verified.add(digest)
+            self._record(artifact.url, digest)
+            if expected is None:
+                self._pin(artifact.url, digest)
+            return digest
+
+    def build(self, *paths: str) -> str:
+        """
+        Pack the given files and directories into a tarball, built again only when their content changed, and
+        return its hash
+        """
+        key = f"tar:{tree_digest(paths)}"
+        with self._key_lock(key):
+            digest = self._index.get(key)
+            if digest is not None and self._valid(digest):
+                return digest
+
+            with io.BytesIO() as f:
+                with tarfile.open(fileobj=f, mode="w:gz") as tar:
+                    for path in paths:
+                        tar.add(path, filter=exclude_bytecode)
+                content = f.getvalue()
+            digest = hashlib.sha256(content).hexdigest()
+            self._make_root()
+            with open(self.path(digest), "wb") as f:
+                f.write(content)
+            self._verified.add(digest)
+            self._record(key, digest)
+            return digest
+
+    def push(self, cli: SSHClient, digest: str, remote_path: str):
+        """
+        Copy the artifact to the host, unless it already holds it
+        """
+        if remote_digest(cli, remote_path) == digest:
+            logger.info(f"Skipping upload of {remote_path}, already up to date")
+            return
+
+        logger.info(f"Uploading {remote_path}")
+        with cli.open_sftp() as sftp:
+            sftp.put(self.path(digest), remote_path)
+        remote = remote_digest(cli, remote_path)
+        if remote != digest:
+            raise ChecksumError(f"{remote_path} has hash {remote or 'none'} on the host after upload, "
+                                f"expected {digest}")
+
+    def _make_root(self):
+        # Only created when something is stored, so that importing the module or destroying leaves no directory
+        os.makedirs(os.path.join(self.root, "sha256"), exist_ok=True)
+
+    def _valid(self, digest: str) -> bool:
+        if digest not in self._verified:
+            if not os.path.exists(self.path(digest)) or file_digest(self.path(digest)) != digest:
+                return False
+            self._verified.add(digest)
+        return True
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        # Steps needing the same artifact at the same time wait for a single download
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _record(self, key: str, digest: str):
+        with self._lock:
+            self._index[key] = digest
+            tmp = f"{self._index_path}.part"
+            with open(tmp, "w") as f:
+                json.dump(self._index, f, indent=2)
+            os.replace(tmp, self._index_path)
+
+    def _pin(self, url: str, digest: str):
+        logger.warning(f"No hash pinned for {url}, pinned it to {digest} from its first download, review and "
+                       f"commit {self.lock}")
+        with self._lock:
+            PINS[url] = digest
+            pins = load_pins(self.lock)
+            pins[url] = digest
+            tmp = f"{self.lock}.part"
+            with open(tmp, "w") as f:
+                json.dump(pins, f, indent=2)
+                f.write("\n")
+            os.replace(tmp, self.lock)
+
+
+def remote_digest(cli: SSHClient, remote_path: str) -> str:
+    _, stdout, _ = cli.exec_command(f"sha256sum {remote_path} 2>/dev/null")
+    return stdout.read().decode().split(" ", 1)[0]
+
+
+def file_digest(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def tree_digest(paths) -> str:
+    """
+    Hash of the names and content of the given files, and of the files under the given directories
+    """
+    sha = hashlib.sha256()
+    for path in paths:
+        files = [path] if os.path.isfile(path) else sorted(
+            os.path.join(d, name) for d, dirs, names in os.walk(path) if "__pycache__" not in d for name in names)
+        for file in files:
+            if file.endswith((".pyc", ".pyo")):
+                continue
+            sha.update(file.encode() + b"\0")
+            sha.update(file_digest(file).encode())
+    return sha.hexdigest()
+
+
+def exclude_bytecode(info: tarfile.TarInfo) -> tarfile.TarInfo | None:
+    if "__pycache__" in info.name or info.name.endswith((".pyc", ".pyo")):
+        return None
+    return info
+
+
+ARTIFACTS = ArtifactCache()
+
+
+def pin():
+    """
+    Download the upstream artifacts, pinning those which are not pinned yet
+    """
+    for artifact in UPSTREAM:
+        ARTIFACTS.fetch(artifact)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] != ["pin"]:
+        sys.exit("usage: python -m deploy.artifacts pin")
+    pin()
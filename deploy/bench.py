@@ -1,37 +1,211 @@
+import csv
+import json
 import logging
+import os
+import re
+import sys
+from dataclasses import dataclass
 
-from paramiko.client import SSHClient
+from rich.logging import RichHandler
 
-from deploy.instances import ssh_connect, ssh_exec
+from deploy.ssh import ssh_exec, ssh_session
 
 logger = logging.getLogger(__name__)
 
+# Benchmark matrix, every workload is run with every thread count against every table size
+BENCH_WORKLOADS = os.environ.get(
+    "BENCH_WORKLOADS", "oltp_read_only,oltp_write_only,oltp_read_write,oltp_point_select").split(",")
+BENCH_THREADS = [int(n) for n in os.environ.get("BENCH_THREADS", "1,6,16").split(",")]
+BENCH_TABLE_SIZES = [int(n) for n in os.environ.get("BENCH_TABLE_SIZES", "20000").split(",")]
+# Seconds each run lasts
+BENCH_TIME = int(os.environ.get("BENCH_TIME", "60"))
 
-def run_benchmarks_standalone(host: str):
-    logger.info("Running benchmarks on standalone MySQL")
-    with SSHClient() as ssh:
-        ssh_connect(ssh, host)
+# Where sysbench outputs are fetched to, along with the parsed results and the comparison report
+BENCH_RESULTS_DIR = os.environ.get("BENCH_RESULTS_DIR", "bench_results")
 
-        ssh_exec("run sysbench standalone", ssh, r"""
-            sudo apt-get install -y sysbench
-            sysbench oltp_read_write --mysql-user=ubuntu --mysql-password=ubuntu --mysql-db=sakila --table-size=20000 --db-driver=mysql prepare
-            sysbench oltp_read_write --mysql-user=ubuntu --mysql-password=ubuntu --mysql-db=sakila --table-size=20000 --db-driver=mysql --threads=6 --time=60 --max-requests=0 run > output.txt
-            sysbench oltp_read_write --mysql-user=ubuntu --mysql-password=ubuntu --mysql-db=sakila --table-size=20000 --db-driver=mysql cleanup
-            """)
+_RUN_FILE = re.compile(r"(?P<workload>\w+)-t(?P<threads>\d+)-s(?P<table_size>\d+)\.txt")
+
+_METRICS = {
+    "transactions": re.compile(r"transactions:\s+(\d+)\s+\(([\d.]+) per sec\.\)"),
+    "queries": re.compile(r"^\s*queries:\s+(\d+)\s+\(([\d.]+) per sec\.\)", re.MULTILINE),
+    "errors": re.compile(r"ignored errors:\s+(\d+)"),
+    "reconnects": re.compile(r"reconnects:\s+(\d+)"),
+    "total_time_s": re.compile(r"total time:\s+([\d.]+)s"),
+    "latency_min_ms": re.compile(r"min:\s+([\d.]+)"),
+    "latency_avg_ms": re.compile(r"avg:\s+([\d.]+)"),
+    "latency_max_ms": re.compile(r"max:\s+([\d.]+)"),
+    "latency_p95_ms": re.compile(r"95th percentile:\s+([\d.]+)"),
+}
+_HISTOGRAM_ROW = re.compile(r"^\s*([\d.]+)\s+\|\**\s+(\d+)\s*$", re.MULTILINE)
+
+FIELDS = ["target", "workload", "threads", "table_size", "tps", "qps", "transactions", "queries", "errors",
+          "reconnects", "total_time_s", "latency_min_ms", "latency_avg_ms", "latency_p50_ms", "latency_p95_ms",
+          "latency_p99_ms", "latency_max_ms"]
+
+
+@dataclass(frozen=True)
+class Run:
+    workload: str
+    threads: int
+    table_size: int
+
+    @property
+    def filename(self) -> str:
+        return f"{self.workload}-t{self.threads}-s{self.table_size}.txt"
 
+
+def run_benchmarks_standalone(host: str):
+    logger.info("Running benchmarks on standalone MySQL")
+    run_benchmarks(host, "standalone")
     logger.info("Benchmark on standalone MySQL finished")
 
 
 def run_benchmarks_cluster(host: str):
     logger.info("Running benchmarks on MySQL Cluster")
-    with SSHClient() as ssh:
-        ssh_connect(ssh, host)
+    run_benchmarks(host, "cluster", "--mysql_storage_engine=ndbcluster")
+    logger.info("Benchmark on MySQL Cluster finished")
 
-        ssh_exec("run sysbench cluster", ssh, r"""
+
+def run_benchmarks(host: str, target: str, options: str = ""):
+    """
+    Run the benchmark matrix on the host, and fetch the sysbench output of every run
+    """
+    runs = [Run(workload, threads, size)
+            for size in BENCH_TABLE_SIZES for workload in BENCH_WORKLOADS for threads in BENCH_THREADS]
+
+    with ssh_session(host) as ssh:
+        ssh_exec("install sysbench", ssh, r"""
             sudo apt-get install -y sysbench
-            sysbench oltp_read_write --mysql-user=ubuntu --mysql-password=ubuntu --mysql-db=sakila --table-size=20000 --mysql_storage_engine=ndbcluster --db-driver=mysql prepare
-            sysbench oltp_read_write --mysql-user=ubuntu --mysql-password=ubuntu --mysql-db=sakila --table-size=20000 --mysql_storage_engine=ndbcluster --db-driver=mysql --threads=6 --time=60 --max-requests=0 run > output.txt
-            sysbench oltp_read_write --mysql-user=ubuntu --mysql-password=ubuntu --mysql-db=sakila --table-size=20000 --mysql_storage_engine=ndbcluster --db-driver=mysql cleanup
             """)
 
-    logger.info("Benchmark on MySQL Cluster finished")
+        for size in BENCH_TABLE_SIZES:
+            common = " ".join(filter(None, ["--mysql-user=ubuntu --mysql-password=ubuntu --mysql-db=sakila",
+                                            f"--table-size={size}", options, "--db-driver=mysql"]))
+            script = [
+                f"mkdir -p bench/{target}",
+                f"sysbench oltp_read_write {common} prepare",
+                *(f"sysbench {run.workload} {common} --threads={run.threads} --time={BENCH_TIME} --max-requests=0 "
+                  f"--histogram=on run > bench/{target}/{run.filename}"
+                  for run in runs if run.table_size == size),
+                f"sysbench oltp_read_write {common} cleanup",
+            ]
+            ssh_exec(f"run sysbench {target} with {size} rows", ssh, "\n".join(script))
+
+        local_dir = os.path.join(BENCH_RESULTS_DIR, target)
+        os.makedirs(local_dir, exist_ok=True)
+        with ssh.open_sftp() as sftp:
+            for run in runs:
+                sftp.get(f"bench/{target}/{run.filename}", os.path.join(local_dir, run.filename))
+
+
+def parse_sysbench(output: str) -> dict:
+    """
+    Throughput and latency figures of a sysbench run. The median and 99th percentile latencies are only known
+    when the run printed its histogram.
+    """
+    result = {}
+    for name, pattern in _METRICS.items():
+        match = pattern.search(output)
+        if name in ("transactions", "queries"):
+            result[name] = int(match.group(1)) if match else None
+            result["tps" if name == "transactions" else "qps"] = float(match.group(2)) if match else None
+        elif name in ("errors", "reconnects"):
+            result[name] = int(match.group(1)) if match else None
+        else:
+            result[name] = float(match.group(1)) if match else None
+
+    histogram = [(float(value), int(count)) for value, count in _HISTOGRAM_ROW.findall(output)]
+    result["latency_p50_ms"] = percentile(histogram, 50)
+    result["latency_p99_ms"] = percentile(histogram, 99)
+    return result
+
+
+def percentile(histogram: list[tuple[float, int]], p: float) -> float | None:
+    total = sum(count for _, count in histogram)
+    if total == 0:
+        return None
+    rank = total * p / 100
+    seen = 0
+    for value, count in sorted(histogram):
+        seen += count
+        if seen >= rank:
+            return value
+    return max(value for value, _ in histogram)
+
+
+def collect(results_dir: str = BENCH_RESULTS_DIR) -> list[dict]:
+    """
+    Parse the sysbench outputs fetched for every target
+    """
+    results = []
+    for target in sorted(os.listdir(results_dir)):
+        target_dir = os.path.join(results_dir, target)
+        if not os.path.isdir(target_dir):
+            continue
+        for filename in sorted(os.listdir(target_dir)):
+            match = _RUN_FILE.fullmatch(filename)
+            if match is None:
+                continue
+            with open(os.path.join(target_dir, filename)) as f:
+                parsed = parse_sysbench(f.read())
+            results.append({
+                "target": target,
+                "workload": match["workload"],
+                "threads": int(match["threads"]),
+                "table_size": int(match["table_size"]),
+                **parsed,
+            })
+    return results
+
+
+def write_results(results: list[dict], results_dir: str = BENCH_RESULTS_DIR):
+    with open(os.path.join(results_dir, "results.json"), "w") as f:
+        json.dump(results, f, indent=2)
+    with open(os.path.join(results_dir, "results.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def compare(results: list[dict], baseline: str = "standalone", other: str = "cluster") -> str:
+    """
+    Side by side throughput and latency of both targets, for every run of the matrix
+    """
+    by_run = {}
+    for result in results:
+        by_run.setdefault((result["workload"], result["threads"], result["table_size"]), {})[result["target"]] = result
+
+    def fmt(value, spec: str) -> str:
+        return "-" if value is None else format(value, spec)
+
+    lines = [
+        f"{'workload':<18} {'threads':>7} {'rows':>8} | {baseline + ' tps':>15} {other + ' tps':>12} {'ratio':>6} | "
+        f"{baseline + ' p95':>15} {other + ' p95':>12} (ms)"
+    ]
+    for (workload, threads, size), targets in sorted(by_run.items()):
+        a, b = targets.get(baseline, {}), targets.get(other, {})
+        ratio = b["tps"] / a["tps"] if a.get("tps") and b.get("tps") is not None else None
+        lines.append(
+            f"{workload:<18} {threads:>7} {size:>8} | {fmt(a.get('tps'), '.1f'):>15} {fmt(b.get('tps'), '.1f'):>12} "
+            f"{fmt(ratio, '.2f'):>6} | {fmt(a.get('latency_p95_ms'), '.2f'):>15} "
+            f"{fmt(b.get('latency_p95_ms'), '.2f'):>12}")
+    return "\n".join(lines)
+
+
+def report(results_dir: str = BENCH_RESULTS_DIR) -> list[dict]:
+    """
+    Parse the fetched outputs, save them as JSON and CSV, and write the comparison report
+    """
+    results = collect(results_dir)
+    write_results(results, results_dir)
+    comparison = compare(results)
+    with open(os.path.join(results_dir, "report.txt"), "w") as f:
+        f.write(comparison + "\n")
+    logger.info(f"Benchmark results:\n{comparison}")
+    return results
+
+
+if __name__ == "__main__":
+    # Build the report again from outputs fetched earlier, without touching any instance
+    logging.basicConfig(level=logging.INFO, handlers=[RichHandler()])
+    report(sys.argv[1] if len(sys.argv) > 1 else BENCH_RESULTS_DIR)
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class DependencyFailedError(RuntimeError):
+    pass
+
+
+@dataclass
+class Task:
+    name: str
+    fn: Callable[[], Any]
+    deps: tuple[str, ...] = ()
+    result: Any = None
+    error: BaseException | None = None
+    # Seconds since the start of the run
+    ready: float | None = None
+    start: float | None = None
+    end: float | None = None
+
+    @property
+    def duration(self) -> float:
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+
+@dataclass
+class DAG:
+    """
+    Run blocking steps in threads, each one as soon as the steps it depends on completed, with at most
+    max_concurrency of them running at once.
+
+    When a step fails, the steps depending on it are skipped, while the others keep going. The first error is
+    raised once every step completed or was skipped.
+    """
+
+    max_concurrency: int = 16
+    tasks: dict[str, Task] = field(default_factory=dict)
+
+    def add(self, name: str, fn: Callable[[], Any], *deps: str) -> str:
+        if name in self.tasks:
+            raise ValueError(f"Task '{name}' is already defined")
+        self.tasks[name] = Task(name, fn, deps)
+        return name
+
+    def result(self, name: str) -> Any:
+        return self.tasks[name].result
+
+    async def run(self):
+        self._check()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        futures: dict[str, asyncio.Task] = {}
+        origin = time.perf_counter()
+
+        async def run_task(task: Task):
+            # Every dependency is scheduled before its dependents, see _check()
+            deps = [futures[dep] for dep in task.deps]
+            await asyncio.gather(*deps, return_exceptions=True)
+            failed = [dep for dep in task.deps if self.tasks[dep].error is not None]
+            if failed:
+                task.error = DependencyFailedError(f"Dependencies {', '.join(failed)} of task '{task.name}' failed")
+                logger.warning(f"Skipping task '{task.name}'")
+                return
+
+            task.ready = time.perf_counter() - origin
+            async with semaphore:
+                task.start = time.perf_counter() - origin
+                logger.info(f"Starting task '{task.name}'")
+                try:
+                    task.result = await asyncio.to_thread(task.fn)
+                except Exception as e:
+                    task.error = e
+                    logger.error(f"Task '{task.name}' failed: {e}")
+                finally:
+                    task.end = time.perf_counter() - origin
+            if task.error is None:
+                logger.info(f"Task '{task.name}' finished in {task.duration:.1f}s")
+
+        for name in self._order():
+            futures[name] = asyncio.create_task(run_task(self.tasks[name]))
+        await asyncio.gather(*futures.values())
+
+        logger.info(f"Timings:\n{self.report()}")
+
+        errors = [task.error for task in self.tasks.values()
+                  if task.error is not None and not isinstance(task.error, DependencyFailedError)]
+        if errors:
+            raise errors[0]
+
+    def critical_path(self) -> list[Task]:
+        """
+        Chain of steps that determined the total duration of the run, from the first to the last one
+        """
+        done = [task for task in self.tasks.values() if task.end is not None]
+        if not done:
+            return []
+
+        path = [max(done, key=lambda t: t.end)]
+        while True:
+            deps = [self.tasks[dep] for dep in path[-1].deps if self.tasks[dep].end is not None]
+            if not deps:
+                break
+            # The dependency completing last is the one the step was waiting for
+            path.append(max(deps, key=lambda t: t.end))
+        return path[::-1]
+
+    def report(self) -> str:
+        """
+        Start and duration of every step, the ones on the critical path being marked with a *, and the time each
+        step spent waiting for a free slot once ready
+        """
+        critical = {task.name for task in self.critical_path()}
+        width = max(len("task"), *(len(name) for name in self.tasks))
+        lines = [f"  {'task':<{width}} {'start':>8} {'duration':>9} {'queued':>7}"]
+        for task in sorted(self.tasks.values(), key=lambda t: (t.start is None, t.start or 0.0, t.name)):
+            mark = "*" if task.name in critical else " "
+            if task.start is None:
+                lines.append(f"{mark} {task.name:<{width}} {'skipped':>8}")
+                continue
+            status = "" if task.error is None else "  failed"
+            lines.append(f"{mark} {task.name:<{width}} {task.start:>7.1f}s {task.duration:>8.1f}s "
+                         f"{task.start - task.ready:>6.1f}s{status}")
+
+        total = max((task.end for task in self.tasks.values() if task.end is not None), default=0.0)
+        busy = sum(task.duration for task in self.tasks.values())
+        lines.append(f"Total {total:.1f}s, critical path {' -> '.join(t.name for t in self.critical_path())}, "
+                     f"{busy:.1f}s of work")
+        return "\n".join(lines)
+
+    def _check(self):
+        for task in self.tasks.values():
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise ValueError(f"Task '{task.name}' depends on unknown task '{dep}'")
+        self._order()
+
+    def _order(self) -> list[str]:
+        """
+        Names of the tasks, each one after all of its dependencies
+        """
+        order = []
+        state: dict[str, bool] = {}
+
+        def visit(name: str, chain: tuple[str, ...]):
+            if state.get(name):
+                return
+            if name in state:
+                raise ValueError(f"Dependency cycle: {' -> '.join((*chain, name))}")
+            state[name] = False
+            for dep in self.tasks[name].deps:
+                visit(dep, (*chain, name))
+            state[name] = True
+            order.append(name)
+
+        for name in self.tasks:
+            visit(name, ())
+        return order
@@ -1,19 +1,36 @@
-import io
+import hashlib
+import json
 import logging
-import tarfile
+import os
+import zipfile
+from functools import partial
+
 import backoff
+import mysql.connector
 
-from textwrap import dedent
-from mypy_boto3_ec2.service_resource import Instance
-from paramiko.client import SSHClient, AutoAddPolicy
-from paramiko.rsakey import RSAKey
+from paramiko.client import SSHClient
 from paramiko.ssh_exception import NoValidConnectionsError
 
+from deploy.artifacts import ARTIFACTS, MYSQL_CLUSTER_BUNDLE, MYSQL_CLUSTER_DATA_NODE, \
+    MYSQL_CLUSTER_MANAGEMENT_SERVER, SAKILA, Artifact
+from deploy.loader import load, parse_dependencies, parse_dump
+from deploy.provision import Node
+from deploy.ssh import SSHExecError, ssh_exec, ssh_session
+from deploy.state import STATE
+
 logger = logging.getLogger(__name__)
 
+# Files shared by the proxy and gatekeeper images
+APP_FILES = ("pyproject.toml", "poetry.lock", "common/")
 
-class SSHExecError(RuntimeError):
-    pass
+# Copies of every row kept by the data nodes, their number must be a multiple of it
+CLUSTER_REPLICAS = int(os.environ.get("CLUSTER_REPLICAS", "3"))
+# Directory of the proxy host holding the backends file, mounted in the proxy container
+PROXY_CONFIG_DIR = "proxy-config"
+# Run by load_sakila, on the sakila-db.zip unzipped by the setup
+SAKILA_SCHEMA_SCRIPT = r"""
+    sudo mysql -e "SOURCE sakila-db/sakila-schema.sql;"
+    """
 
 
 # Commands from DigitalOcean documentation:
@@ -21,11 +38,9 @@ class SSHExecError(RuntimeError):
 
 
 @backoff.on_exception(backoff.constant, (NoValidConnectionsError, TimeoutError))
-def setup_mysql_single(inst: Instance):
+def setup_mysql_single(inst: Node):
     logger.info("Setting up MySQL instance (n=1)")
-    with SSHClient() as ssh_cli:
-        ssh_connect(ssh_cli, inst.public_ip_address)
-
+    with ssh_session(inst.public_ip_address) as ssh_cli:
         ssh_exec("install deps", ssh_cli, r"""
             sudo apt-get update
             sudo apt-get install -y mysql-server
@@ -41,22 +56,20 @@ def setup_mysql_single(inst: Instance):
 
         wait_mysql(ssh_cli)
 
+        push_artifact(ssh_cli, SAKILA)
         ssh_exec("install sakila db single", ssh_cli, r"""
-            wget https://downloads.mysql.com/docs/sakila-db.zip
-            unzip sakila-db.zip
-            sudo mysql -e "CREATE USER 'ubuntu'@'%' IDENTIFIED BY 'ubuntu';"
+            unzip -o sakila-db.zip
+            sudo mysql -e "CREATE USER IF NOT EXISTS 'ubuntu'@'%' IDENTIFIED BY 'ubuntu';"
             sudo mysql -e "GRANT ALL PRIVILEGES ON *.* TO 'ubuntu'@'%' WITH GRANT OPTION;"
             sudo mysql -e "FLUSH PRIVILEGES;"
-            sudo mysql -e "SOURCE sakila-db/sakila-schema.sql;"
-            sudo mysql -e "SOURCE sakila-db/sakila-data.sql;"
             """)
 
+        load_sakila(ssh_cli, inst)
 
-@backoff.on_exception(backoff.constant, (NoValidConnectionsError, TimeoutError))
-def setup_mysql_cluster_manager(manager: Instance, workers: list[Instance]):
-    with SSHClient() as ssh_cli:
-        ssh_connect(ssh_cli, manager.public_ip_address)
 
+@backoff.on_exception(backoff.constant, (NoValidConnectionsError, TimeoutError))
+def setup_mysql_cluster_manager(manager: Node, workers: list[Node]):
+    with ssh_session(manager.public_ip_address) as ssh_cli:
         ssh_exec("install deps", ssh_cli, r"""
             sudo add-apt-repository -y universe
             sudo apt update
@@ -65,56 +78,33 @@ def setup_mysql_cluster_manager(manager: Instance, workers: list[Instance]):
 
         # Install the manager
 
+        push_artifact(ssh_cli, MYSQL_CLUSTER_MANAGEMENT_SERVER)
+        digest = push_file(ssh_cli, cluster_config(manager, workers), "config.ini")
+        # The hash of the configuration makes both scripts run again whenever the nodes change
         ssh_exec("install manager", ssh_cli, rf"""
-            mkdir mysql
-            cd mysql
-            wget https://dev.mysql.com/get/Downloads/MySQL-Cluster-7.6/mysql-cluster-community-management-server_7.6.6-1ubuntu18.04_amd64.deb
             sudo dpkg -i mysql-cluster-community-management-server_7.6.6-1ubuntu18.04_amd64.deb
-            sudo mkdir /var/lib/mysql-cluster
-            sudo tee /var/lib/mysql-cluster/config.ini <<EOF
-            [ndbd default]
-            NoOfReplicas=3
-            datadir=/usr/local/mysql/data
-            
-            [ndb_mgmd]
-            hostname={manager.private_ip_address}
-            datadir=/var/lib/mysql-cluster
-            
-            [ndbd]
-            NodeId=2
-            hostname={workers[0].private_ip_address}
-            
-            [ndbd]
-            NodeId=3
-            hostname={workers[1].private_ip_address}
-            
-            [ndbd]
-            NodeId=4
-            hostname={workers[2].private_ip_address}
-
-            [mysqld]
-            hostname={manager.private_ip_address}
-            EOF
+            sudo mkdir -p /var/lib/mysql-cluster
+            echo "{digest}  config.ini" | sha256sum -c
+            sudo cp config.ini /var/lib/mysql-cluster/config.ini
             """)
 
-        ssh_exec("run ndb_mgmd", ssh_cli, r"""
+        ssh_exec("run ndb_mgmd", ssh_cli, rf"""
+            echo "{digest}  /var/lib/mysql-cluster/config.ini" | sha256sum -c
+            sudo pkill -x ndb_mgmd && sleep 2 || true
             sudo ndb_mgmd --reload -f /var/lib/mysql-cluster/config.ini --initial
             """)
 
-        ssh_exec("firewall", ssh_cli, rf"""
-            sudo ufw allow from {manager.private_ip_address}
-            sudo ufw allow from {workers[0].private_ip_address}
-            sudo ufw allow from {workers[1].private_ip_address}
-            sudo ufw allow from {workers[2].private_ip_address}
-            """)
+        ssh_exec("firewall", ssh_cli, firewall_script([manager, *workers]))
 
-        # Install the server/client
 
+@backoff.on_exception(backoff.constant, (NoValidConnectionsError, TimeoutError))
+def setup_mysql_cluster_sql_node(manager: Node):
+    with ssh_session(manager.public_ip_address) as ssh_cli:
+        push_artifact(ssh_cli, MYSQL_CLUSTER_BUNDLE)
         ssh_exec("install mysql server/client", ssh_cli, rf"""
-            mkdir mysql-c
+            mkdir -p mysql-c
+            tar -xvf mysql-cluster_7.6.6-1ubuntu18.04_amd64.deb-bundle.tar -C mysql-c
             cd mysql-c
-            wget https://dev.mysql.com/get/Downloads/MySQL-Cluster-7.6/mysql-cluster_7.6.6-1ubuntu18.04_amd64.deb-bundle.tar
-            tar -xvf mysql-cluster_7.6.6-1ubuntu18.04_amd64.deb-bundle.tar
             sudo dpkg -i mysql-common_7.6.6-1ubuntu18.04_amd64.deb
             sudo dpkg -i mysql-cluster-community-client_7.6.6-1ubuntu18.04_amd64.deb
             sudo dpkg -i mysql-client_7.6.6-1ubuntu18.04_amd64.deb
@@ -134,20 +124,16 @@ def setup_mysql_cluster_manager(manager: Instance, workers: list[Instance]):
 
 
 @backoff.on_exception(backoff.constant, (NoValidConnectionsError, TimeoutError))
-def setup_mysql_cluster_worker(manager: Instance, worker: 'Instance', workers: list['Instance'], proxy: Instance):
-    with SSHClient() as ssh_cli:
-        ssh_connect(ssh_cli, worker.public_ip_address)
-
+def setup_mysql_cluster_worker(manager: Node, worker: Node, workers: list[Node], proxy: Node):
+    with ssh_session(worker.public_ip_address) as ssh_cli:
         ssh_exec("install deps", ssh_cli, r"""
             sudo add-apt-repository -y universe
             sudo apt update
             sudo apt install -y libaio1 libmecab2 libtinfo5 libclass-methodmaker-perl
             """)
 
+        push_artifact(ssh_cli, MYSQL_CLUSTER_DATA_NODE)
         ssh_exec("install cluster datanode", ssh_cli, rf"""
-            mkdir mysql
-            cd mysql
-            wget https://dev.mysql.com/get/Downloads/MySQL-Cluster-7.6/mysql-cluster-community-data-node_7.6.6-1ubuntu18.04_amd64.deb
             sudo dpkg -i mysql-cluster-community-data-node_7.6.6-1ubuntu18.04_amd64.deb
             sudo tee -a /etc/my.cnf <<EOF
             [mysql_cluster]
@@ -156,120 +142,163 @@ def setup_mysql_cluster_worker(manager: Instance, worker: 'Instance', workers: l
             sudo mkdir -p /usr/local/mysql/data
             """)
 
-        ssh_exec("firewall", ssh_cli, rf"""
-            sudo ufw allow from {manager.private_ip_address}
-            sudo ufw allow from {workers[0].private_ip_address}
-            sudo ufw allow from {workers[1].private_ip_address}
-            sudo ufw allow from {workers[2].private_ip_address}
-            sudo ufw allow from {proxy.private_ip_address}
-            """)
+        ssh_exec("firewall", ssh_cli, firewall_script([manager, *workers, proxy]))
 
+
+@backoff.on_exception(backoff.constant, (NoValidConnectionsError, TimeoutError))
+def start_mysql_cluster_worker(worker: Node):
+    with ssh_session(worker.public_ip_address) as ssh_cli:
         ssh_exec("run ndbd", ssh_cli, r"""
             sudo ndbd
             """)
 
 
 @backoff.on_exception(backoff.constant, (NoValidConnectionsError, TimeoutError))
-def post_setup_mysql_cluster(manager: Instance):
-    with SSHClient() as ssh_cli:
-        ssh_connect(ssh_cli, manager.public_ip_address)
+def post_setup_mysql_cluster(manager: Node):
+    with ssh_session(manager.public_ip_address) as ssh_cli:
+        push_artifact(ssh_cli, SAKILA)
         ssh_exec("install sakila db", ssh_cli, r"""
-            wget https://downloads.mysql.com/docs/sakila-db.zip
-            unzip sakila-db.zip
-            sudo mysql -e "CREATE USER 'ubuntu'@'%' IDENTIFIED BY 'ubuntu';"
+            unzip -o sakila-db.zip
+            sudo mysql -e "CREATE USER IF NOT EXISTS 'ubuntu'@'%' IDENTIFIED BY 'ubuntu';"
             sudo mysql -e "GRANT ALL PRIVILEGES ON *.* TO 'ubuntu'@'%' WITH GRANT OPTION;"
             sudo mysql -e "FLUSH PRIVILEGES;"
-            sudo mysql -e "SOURCE sakila-db/sakila-schema.sql;"
-            sudo mysql -e "SOURCE sakila-db/sakila-data.sql;"
             """)
 
+        load_sakila(ssh_cli, manager)
 
-@backoff.on_exception(backoff.constant, (NoValidConnectionsError, TimeoutError, SSHExecError))
-def setup_proxy(inst: Instance, manager: Instance, workers: list[Instance]):
-    with SSHClient() as ssh_cli:
-        ssh_connect(ssh_cli, inst.public_ip_address)
 
+@backoff.on_exception(backoff.constant, (NoValidConnectionsError, TimeoutError, SSHExecError))
+def setup_proxy(inst: Node, manager: Node, workers: list[Node]):
+    with ssh_session(inst.public_ip_address) as ssh_cli:
         ssh_exec("install docker", ssh_cli, r"""
             sudo snap install docker
             """)
 
-        with ssh_cli.open_sftp() as sftp:
-            with io.BytesIO() as f:
-                with tarfile.open(fileobj=f, mode='w:gz') as tar:
-                    tar.add("pyproject.toml")
-                    tar.add("poetry.lock")
-                    tar.add("proxy/")
-                f.seek(0)
-                sftp.putfo(f, "proxy.tar.gz")
+        # Written apart from the container, so that adding or removing slaves does not restart it
+        backends = json.dumps({"manager": manager.private_ip_address,
+                               "slaves": [worker.private_ip_address for worker in workers]}, indent=2)
+        ssh_exec("proxy config dir", ssh_cli, f"mkdir -p {PROXY_CONFIG_DIR}")
+        backends_digest = push_file(ssh_cli, backends, f"{PROXY_CONFIG_DIR}/backends.json.new")
+        ssh_exec("configure proxy backends", ssh_cli, rf"""
+            echo "{backends_digest}  {PROXY_CONFIG_DIR}/backends.json.new" | sha256sum -c
+            mv {PROXY_CONFIG_DIR}/backends.json.new {PROXY_CONFIG_DIR}/backends.json
+            """)
+
+        digest = ARTIFACTS.build(*APP_FILES, "proxy/")
+        ARTIFACTS.push(ssh_cli, digest, "proxy.tar.gz")
 
+        # The hash of the tarball makes the script run again whenever the code changed
         ssh_exec("start proxy", ssh_cli, rf"""
+            echo "{digest}  proxy.tar.gz" | sha256sum -c
             rm -rf app && mkdir -p app
             tar xzf proxy.tar.gz -C app/
             cd app
             sudo docker build -t proxy -f proxy/Dockerfile .
-            sudo docker run -d -p 80:8080 \
-                -e MANAGER_HOST={manager.private_ip_address} \
-                -e SLAVE_1_HOST={workers[0].private_ip_address} \
-                -e SLAVE_2_HOST={workers[1].private_ip_address} \
-                -e SLAVE_3_HOST={workers[2].private_ip_address} \
+            sudo docker rm -f proxy || true
+            sudo docker run -d --name proxy -p 80:8080 \
+                -v "$HOME/{PROXY_CONFIG_DIR}:/etc/proxy:ro" \
+                -e BACKENDS_FILE=/etc/proxy/backends.json \
                 proxy
             """)
 
 
 @backoff.on_exception(backoff.constant, (NoValidConnectionsError, TimeoutError, SSHExecError))
-def setup_gatekeeper(inst: Instance, forward_inst: Instance):
-    with SSHClient() as ssh_cli:
-        ssh_connect(ssh_cli, inst.public_ip_address)
-
+def setup_gatekeeper(inst: Node, forward_inst: Node, forwarders: tuple[Node, ...] = ()):
+    """
+    Run a gatekeeper forwarding to the given instance. Clients of requests coming from the forwarders are read from
+    their X-Forwarded-For header, so that each one gets its own admission limits.
+    """
+    trusted = ",".join(node.private_ip_address for node in forwarders)
+    with ssh_session(inst.public_ip_address) as ssh_cli:
         ssh_exec("install docker", ssh_cli, r"""
             sudo snap install docker
             """)
 
-        with ssh_cli.open_sftp() as sftp:
-            with io.BytesIO() as f:
-                with tarfile.open(fileobj=f, mode='w:gz') as tar:
-                    tar.add("pyproject.toml")
-                    tar.add("poetry.lock")
-                    tar.add("gatekeeper/")
-                f.seek(0)
-                sftp.putfo(f, "gatekeeper.tar.gz")
+        digest = ARTIFACTS.build(*APP_FILES, "gatekeeper/")
+        ARTIFACTS.push(ssh_cli, digest, "gatekeeper.tar.gz")
 
+        # The hash of the tarball makes the script run again whenever the code changed
         ssh_exec("start gatekeeper", ssh_cli, rf"""
+            echo "{digest}  gatekeeper.tar.gz" | sha256sum -c
             rm -rf app && mkdir -p app
             tar xzf gatekeeper.tar.gz -C app/
             cd app
             sudo docker build -t gatekeeper -f gatekeeper/Dockerfile .
-            sudo docker run -d -p 80:8080 -e PROXY_HOST={forward_inst.private_ip_address} gatekeeper
+            sudo docker rm -f gatekeeper || true
+            sudo docker run -d --name gatekeeper -p 80:8080 -e PROXY_HOST={forward_inst.private_ip_address} \
+                -e TRUSTED_FORWARDERS={trusted} \
+                gatekeeper
             """)
 
 
-def ssh_connect(cli: SSHClient, ip: str):
-    cli.set_missing_host_key_policy(AutoAddPolicy())
-    cli.connect(
-        hostname=ip,
-        username='ubuntu',
-        pkey=RSAKey.from_private_key_file('keypair.pem')
-    )
+def load_sakila(ssh_cli: SSHClient, inst: Node):
+    """
+    Create the sakila tables, then load their rows from the deploy host, several tables at once, in large batches.
+
+    Both are a single step: the schema drops the tables, so it runs again with the load until the rows were all
+    loaded, and a load interrupted midway starts over from empty tables rather than inserting duplicates.
+    """
+    digest = ARTIFACTS.fetch(SAKILA)
+    key = STATE.step_key(inst.public_ip_address, "install sakila", f"{digest}\0{SAKILA_SCHEMA_SCRIPT}")
+    if STATE.done(key):
+        logger.info("Skipping sakila, already installed")
+        return
+
+    ssh_exec("sakila schema", ssh_cli, SAKILA_SCHEMA_SCRIPT, resumable=False)
+    with zipfile.ZipFile(ARTIFACTS.path(digest)) as archive:
+        dump = parse_dump(archive.read("sakila-db/sakila-data.sql").decode())
+        deps = parse_dependencies(archive.read("sakila-db/sakila-schema.sql").decode())
+    load(partial(mysql.connector.connect, host=inst.public_ip_address, user="ubuntu", password="ubuntu",
+                 database="sakila"), dump, deps)
+    STATE.complete(key)
+
+
+def cluster_config(manager: Node, workers: list[Node], replicas: int = CLUSTER_REPLICAS) -> str:
+    """
+    config.ini of the management node, with one data node per worker
+    """
+    check_replicas(len(workers), replicas)
+    sections = [
+        f"[ndbd default]\nNoOfReplicas={replicas}\ndatadir=/usr/local/mysql/data",
+        f"[ndb_mgmd]\nhostname={manager.private_ip_address}\ndatadir=/var/lib/mysql-cluster",
+        # Node 1 is the management node
+        *(f"[ndbd]\nNodeId={i}\nhostname={worker.private_ip_address}" for i, worker in enumerate(workers, start=2)),
+        f"[mysqld]\nhostname={manager.private_ip_address}",
+    ]
+    return "\n\n".join(sections) + "\n"
+
+
+def check_replicas(data_nodes: int, replicas: int = CLUSTER_REPLICAS):
+    if not 1 <= replicas <= 4 or data_nodes < replicas or data_nodes % replicas:
+        raise ValueError(f"{data_nodes} data nodes cannot hold {replicas} replicas, NoOfReplicas must be between "
+                         f"1 and 4 and divide the number of data nodes")
+
+
+def firewall_script(nodes: list[Node]) -> str:
+    return "\n".join(f"sudo ufw allow from {node.private_ip_address}" for node in nodes)
+
+
+def push_file(cli: SSHClient, content: str, remote_path: str) -> str:
+    """
+    Write the content to a file of the host, and return its hash
+    """
+    with cli.open_sftp() as sftp, sftp.open(remote_path, "w") as f:
+        f.write(content)
+    return hashlib.sha256(content.encode()).hexdigest()
 
 
-def ssh_exec(name: str, cli: SSHClient, cmd: str):
-    cmd = dedent(cmd)
-    logger.info(f"Executing script {name}")
-    logger.info(f"SSH >> {cmd}")
-    stdin, stdout, stderr = cli.exec_command(cmd, get_pty=True)
-    status = stdout.channel.recv_exit_status()
-    logger.info(f"Script {name} finished with status {status}")
-    if status != 0:
-        logger.error(f"SSH error >> {stdout.read().decode().strip()}")
-        err = stderr.read().decode().strip()
-        logger.error(f"SSH error >> {err}")
-        raise SSHExecError(err)
+def push_artifact(cli: SSHClient, artifact: Artifact):
+    """
+    Copy the artifact to the home directory of the host, downloading it first if it is not cached yet
+    """
+    ARTIFACTS.push(cli, ARTIFACTS.fetch(artifact), artifact.filename)
 
 
 def wait_mysql(cli: SSHClient):
+    # MySQL may have been restarted since, by this deployment or a previous one
     ssh_exec("waiting mysql to be ready", cli, r"""
         while ! sudo mysql -e "SHOW DATABASES;"; do
             echo "MySQL is not ready yet. Waiting 1 second..."
             sleep 1
         done
-        """)
+        """, resumable=False)
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Callable
+
+from deploy.dag import DAG
+
+logger = logging.getLogger(__name__)
+
+# Rows sent per INSERT statement, and tables loaded at the same time
+LOADER_BATCH_SIZE = int(os.environ.get("LOADER_BATCH_SIZE", "1000"))
+LOADER_PARALLELISM = int(os.environ.get("LOADER_PARALLELISM", "4"))
+
+# Parts of a dump a statement or a row boundary can never be found in, followed by the delimiters
+_STATEMENT_TOKEN = re.compile(
+    r"""'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|`(?:[^`]|``)*`|/\*.*?\*/|--[^\n]*|#[^\n]*|;""", re.DOTALL)
+_ROW_TOKEN = re.compile(r"""'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*"|/\*.*?\*/|[()]""", re.DOTALL)
+_LEADING_COMMENTS = re.compile(r"^(?:\s+|--[^\n]*|#[^\n]*|/\*[^!].*?\*/)*", re.DOTALL)
+
+_INSERT = re.compile(r"INSERT\s+INTO\s+`?(\w+)`?\s*(\([^)]*\))?\s*VALUES\s*", re.IGNORECASE)
+_CREATE_TABLE = re.compile(r"CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?`?(\w+)`?", re.IGNORECASE)
+_REFERENCES = re.compile(r"REFERENCES\s+`?(\w+)`?", re.IGNORECASE)
+# Statements changing the state of the session, replayed on every connection before loading
+_SESSION = re.compile(r"^(?:SET\b|USE\b|/\*!)", re.IGNORECASE)
+
+
+@dataclass
+class Table:
+    name: str
+    columns: str = ""
+    rows: list[str] = field(default_factory=list)
+
+
+@dataclass
+class Dump:
+    session: list[str] = field(default_factory=list)
+    tables: dict[str, Table] = field(default_factory=dict)
+
+
+@dataclass
+class LoadStats:
+    table: str
+    rows: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+
+def split_statements(sql: str) -> list[str]:
+    statements = []
+    start = 0
+    for match in _STATEMENT_TOKEN.finditer(sql):
+        if match.group() == ";":
+            statements.append(sql[start:match.start()])
+            start = match.end()
+    statements.append(sql[start:])
+    return [statement for statement in (_LEADING_COMMENTS.sub("", s).strip() for s in statements) if statement]
+
+
+def split_rows(values: str) -> list[str]:
+    """
+    Row tuples of the VALUES list of an INSERT statement, as written in the statement
+    """
+    rows = []
+    depth = 0
+    start = 0
+    for match in _ROW_TOKEN.finditer(values):
+        match match.group():
+            case "(":
+                if depth == 0:
+                    start = match.start()
+                depth += 1
+            case ")":
+                depth -= 1
+                if depth == 0:
+                    rows.append(values[start:match.end()])
+    return rows
+
+
+def parse_dump(sql: str) -> Dump:
+    """
+    Group the rows inserted by the dump per table, and keep the statements setting up the session before them
+    """
+    dump = Dump()
+    for statement in split_statements(sql):
+        insert = _INSERT.match(statement)
+        if insert is not None:
+            name, columns = insert.group(1), insert.group(2) or ""
+            table = dump.tables.setdefault(name, Table(name, columns))
+            table.rows.extend(split_rows(statement[insert.end():]))
+        elif _SESSION.match(statement) and not dump.tables \
+                and not re.match(r"SET\s+AUTOCOMMIT\b", statement, re.IGNORECASE):
+            # The ones at the end of the dump restore the session as it was, checks included
+            dump.session.append(statement)
+        else:
+            # Transactions, table locks and keys are handled by the loader itself
+            logger.debug(f"Ignoring statement '{statement[:80]}'")
+    return dump
+
+
+def parse_dependencies(schema: str) -> dict[str, set[str]]:
+    """
+    Tables referenced by the foreign keys of every table of the schema
+    """
+    deps = {}
+    for statement in split_statements(schema):
+        create = _CREATE_TABLE.match(statement)
+        if create is not None:
+            name = create.group(1)
+            deps[name] = {ref for ref in _REFERENCES.findall(statement) if ref != name}
+    return deps
+
+
+def load(connect: Callable, dump: Dump, deps: dict[str, set[str]], batch_size: int = LOADER_BATCH_SIZE,
+         parallelism: int = LOADER_PARALLELISM) -> list[LoadStats]:
+    """
+    Insert the rows of the dump, each table as soon as the tables it references are loaded, with up to
+    parallelism tables loaded at once, each over its own connection.
+
+    Tables referencing each other, directly or not, are loaded together in a single step.
+    """
+    groups = strongly_connected(list(dump.tables), deps)
+    group_of = {table: i for i, group in enumerate(groups) for table in group}
+
+    dag = DAG(max_concurrency=parallelism)
+    names = []
+    for i, group in enumerate(groups):
+        # Only tables of other groups the dump has rows for are worth waiting for
+        needs = {names[group_of[dep]] for table in group for dep in deps.get(table, ())
+                 if dep in group_of and group_of[dep] != i}
+        names.append(dag.add(f"load {', '.join(group)}",
+                             partial(load_group, connect, dump, [dump.tables[t] for t in group], batch_size),
+                             *sorted(needs)))
+
+    asyncio.run(dag.run())
+
+    stats = [stat for name in names for stat in dag.result(name)]
+    for stat in stats:
+        logger.info(f"Loaded {stat.rows} rows into {stat.table} in {stat.seconds:.2f}s "
+                    f"({stat.rows_per_second:.0f} rows/s)")
+    total_rows = sum(stat.rows for stat in stats)
+    total_seconds = max((task.end for task in dag.tasks.values() if task.end is not None), default=0.0)
+    if total_seconds > 0:
+        logger.info(f"Loaded {total_rows} rows in {total_seconds:.2f}s ({total_rows / total_seconds:.0f} rows/s)")
+    return stats
+
+
+def load_group(connect: Callable, dump: Dump, tables: list[Table], batch_size: int) -> list[LoadStats]:
+    conn = connect()
+    try:
+        cursor = conn.cursor()
+        for statement in dump.session:
+            cursor.execute(statement)
+
+        stats = []
+        for table in tables:
+            start = time.perf_counter()
+            for i in range(0, len(table.rows), batch_size):
+                cursor.execute(f"INSERT INTO `{table.name}`{table.columns} VALUES "
+                               f"{','.join(table.rows[i:i + batch_size])}")
+            conn.commit()
+            stats.append(LoadStats(table.name, len(table.rows), time.perf_counter() - start))
+        cursor.close()
+        return stats
+    finally:
+        conn.close()
+
+
+def strongly_connected(tables: list[str], deps: dict[str, set[str]]) -> list[list[str]]:
+    """
+    Tables grouped by dependency cycle, with Tarjan's algorithm, each group listed after the groups it depends on
+    """
+    index: dict[str, int] = {}
+    low: dict[str, int] = {}
+    stack: list[str] = []
+    on_stack: set[str] = set()
+    groups = []
+    selected = set(tables)
+
+    def visit(table: str):
+        index[table] = low[table] = len(index)
+        stack.append(table)
+        on_stack.add(table)
+        for dep in sorted(deps.get(table, ())):
+            if dep not in selected:
+                continue
+            if dep not in index:
+                visit(dep)
+                low[table] = min(low[table], low[dep])
+            elif dep in on_stack:
+                low[table] = min(low[table], index[dep])
+
+        if low[table] == index[table]:
+            group = []
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                group.append(member)
+                if member == table:
+                    break
+            groups.append(sorted(group))
+
+    for table in tables:
+        if table not in index:
+            visit(table)
+    return groups
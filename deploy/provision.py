@@ -0,0 +1,315 @@
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable
+
+from botocore.exceptions import ClientError, ConnectTimeoutError, EndpointConnectionError, HTTPClientError
+
+from deploy.state import STATE
+
+logger = logging.getLogger(__name__)
+
+IMAGE_ID = "ami-053b0d53c279acc90"
+# Data nodes of the MySQL cluster, the slaves the proxy spreads reads over
+CLUSTER_DATA_NODES = int(os.environ.get("CLUSTER_DATA_NODES", "3"))
+# Tag set on every instance of the deployment
+PROJECT_TAG = {"Key": "Project", "Value": "log8415-tp3"}
+
+# States an instance never becomes running from
+FAILED_STATES = {"shutting-down", "terminated", "stopping", "stopped"}
+
+# Errors of describe_instances worth retrying, with a delay doubling up to MAX_RETRY_DELAY seconds
+TRANSIENT_ERROR_CODES = {"RequestLimitExceeded", "Throttling", "ThrottlingException", "InternalError",
+                         "ServiceUnavailable", "Unavailable", "InvalidInstanceID.NotFound"}
+MAX_RETRY_DELAY = 30
+# Seconds wait() gives the poller past the deadline to report the nodes it gave up on
+WAIT_GRACE = 10
+
+
+class ProvisioningError(RuntimeError):
+    pass
+
+
+def transient(e: Exception) -> bool:
+    if isinstance(e, ClientError):
+        return e.response["Error"]["Code"] in TRANSIENT_ERROR_CODES
+    # Connection errors and timeouts talking to the endpoint
+    return isinstance(e, (EndpointConnectionError, ConnectTimeoutError, HTTPClientError))
+
+
+@dataclass(frozen=True)
+class NodeSpec:
+    name: str
+    role: str
+    instance_type: str
+
+
+@dataclass
+class Node:
+    """
+    An instance of the deployment, with the attributes of the EC2 instance the setup steps need
+    """
+    name: str
+    role: str
+    instance_type: str
+    id: str
+    state: str = "pending"
+    public_ip_address: str | None = None
+    private_ip_address: str | None = None
+
+
+@dataclass
+class Topology:
+    standalone: Node
+    manager: Node
+    workers: list[Node]
+    proxy: Node
+    trusted_host: Node
+    gatekeeper: Node
+
+    @property
+    def nodes(self) -> list[Node]:
+        return [self.standalone, self.manager, *self.workers, self.proxy, self.trusted_host, self.gatekeeper]
+
+    @classmethod
+    def from_nodes(cls, nodes: list[Node]) -> 'Topology':
+        by_role = defaultdict(list)
+        for node in nodes:
+            by_role[node.role].append(node)
+        return cls(
+            standalone=by_role["standalone"][0],
+            manager=by_role["manager"][0],
+            workers=by_role["worker"],
+            proxy=by_role["proxy"][0],
+            trusted_host=by_role["trusted-host"][0],
+            gatekeeper=by_role["gatekeeper"][0],
+        )
+
+
+def fleet(data_nodes: int = CLUSTER_DATA_NODES) -> list[NodeSpec]:
+    return [
+        NodeSpec("mysql-standalone", "standalone", "t2.micro"),
+        NodeSpec("mysql-cluster-manager", "manager", "t2.micro"),
+        *(NodeSpec(f"mysql-cluster-worker-{i}", "worker", "t2.micro") for i in range(1, data_nodes + 1)),
+        NodeSpec("proxy", "proxy", "t2.large"),
+        NodeSpec("trusted-host", "trusted-host", "t2.large"),
+        NodeSpec("gatekeeper", "gatekeeper", "t2.large"),
+    ]
+
+
+def ssh_reachable(node: Node, port: int = 22, timeout: float = 3) -> bool:
+    """
+    Whether the SSH server of the node answers, which happens a while after the instance is reported running
+    """
+    try:
+        with socket.create_connection((node.public_ip_address, port), timeout=timeout) as s:
+            s.settimeout(timeout)
+            return s.recv(4).startswith(b"SSH-")
+    except OSError:
+        return False
+
+
+class Provisioner:
+    """
+    Launch the instances of the deployment with one run_instances call per instance type, and track their
+    readiness with a single describe_instances call per poll, shared by every node being waited for.
+
+    Instances recorded in the deployment state are reused as long as they are pending or running.
+    """
+
+    def __init__(self, client, key_name: str, security_group_id: str, availability_zone: str,
+                 image_id: str = IMAGE_ID, poll_interval: float = 2, timeout: float = 600,
+                 ready_check: Callable[[Node], bool] | None = ssh_reachable):
+        self.client = client
+        self.key_name = key_name
+        self.security_group_id = security_group_id
+        self.availability_zone = availability_zone
+        self.image_id = image_id
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.ready_check = ready_check
+
+        self._nodes: dict[str, Node] = {}
+        self._ready: dict[str, threading.Event] = {}
+        self._errors: dict[str, Exception] = {}
+        self._poller: threading.Thread | None = None
+        self._deadline = 0.0
+
+    def launch(self, specs: list[NodeSpec]) -> Topology:
+        """
+        Reuse or create the instances of every node, and start polling for their readiness in the background
+        """
+        nodes = self._reuse(specs)
+        missing = [spec for spec in specs if spec.name not in nodes]
+
+        by_type = defaultdict(list)
+        for spec in missing:
+            by_type[spec.instance_type].append(spec)
+        for instance_type, batch in by_type.items():
+            for node in self._run(instance_type, batch):
+                nodes[node.name] = node
+
+        ordered = [nodes[spec.name] for spec in specs]
+        for node in ordered:
+            self._nodes[node.id] = node
+            self._ready[node.id] = threading.Event()
+        self._deadline = time.monotonic() + self.timeout
+        self._poller = threading.Thread(target=self._poll, name="provision-poller", daemon=True)
+        self._poller.start()
+        return Topology.from_nodes(ordered)
+
+    def wait(self, node: Node):
+        """
+        Block until the node is running, with its addresses known, and reachable if a ready check is set
+        """
+        if not self._ready[node.id].wait(max(0.0, self._deadline - time.monotonic()) + WAIT_GRACE):
+            raise TimeoutError(f"Instance {node.name} not ready after {self.timeout:g}s")
+        error = self._errors.get(node.id)
+        if error is not None:
+            raise error
+
+    def wait_all(self):
+        for node in self._nodes.values():
+            self.wait(node)
+
+    def _reuse(self, specs: list[NodeSpec]) -> dict[str, Node]:
+        known = {spec.name: STATE.resource(f"instance:{spec.name}") for spec in specs}
+        known = {name: instance_id for name, instance_id in known.items() if instance_id is not None}
+        if not known:
+            return {}
+
+        # Unknown ids make the whole call fail, so instances are filtered on their id instead
+        res = self.client.describe_instances(Filters=[{"Name": "instance-id", "Values": list(known.values())}])
+        states = {inst["InstanceId"]: inst for r in res["Reservations"] for inst in r["Instances"]}
+
+        nodes = {}
+        for spec in specs:
+            inst = states.get(known.get(spec.name))
+            if inst is not None and inst["State"]["Name"] in ("pending", "running"):
+                logger.info(f"Reusing instance {spec.name}")
+                nodes[spec.name] = self._update(Node(spec.name, spec.role, spec.instance_type, inst["InstanceId"]),
+                                                inst)
+        return nodes
+
+    def _run(self, instance_type: str, batch: list[NodeSpec]) -> list[Node]:
+        logger.info(f"Creating {len(batch)} {instance_type} instances: {', '.join(spec.name for spec in batch)}")
+        res = self.client.run_instances(
+            KeyName=self.key_name,
+            SecurityGroupIds=[self.security_group_id],
+            InstanceType=instance_type,
+            ImageId=self.image_id,
+            Placement={"AvailabilityZone": self.availability_zone},
+            MinCount=len(batch),
+            MaxCount=len(batch),
+            BlockDeviceMappings=[
+                {
+                    "DeviceName": "/dev/sda1",
+                    "Ebs": {
+                        "DeleteOnTermination": True,
+                        "VolumeSize": 15,
+                        "VolumeType": "gp2",
+                    }
+                }
+            ],
+            TagSpecifications=[{"ResourceType": "instance", "Tags": [PROJECT_TAG]}],
+        )
+
+        nodes = []
+        for spec, inst in zip(batch, res["Instances"]):
+            STATE.set_resource(f"instance:{spec.name}", inst["InstanceId"])
+            nodes.append(Node(spec.name, spec.role, spec.instance_type, inst["InstanceId"]))
+        # Instances of a single call share their tags, names are set once their ids are known
+        for node in nodes:
+            self._tag(node)
+        return nodes
+
+    def _tag(self, node: Node):
+        tags = [{"Key": "Name", "Value": node.name}, {"Key": "Role", "Value": node.role}]
+        for attempt in range(10):
+            try:
+                self.client.create_tags(Resources=[node.id], Tags=tags)
+                return
+            except ClientError as e:
+                # New instances take a moment to be known to every endpoint
+                if e.response["Error"]["Code"] != "InvalidInstanceID.NotFound" or attempt == 9:
+                    raise
+                time.sleep(self.poll_interval)
+
+    def _poll(self):
+        try:
+            self._poll_loop()
+        except Exception as e:
+            # Nodes left waiting would otherwise never be released
+            logger.exception("Polling instances failed")
+            for node in self._nodes.values():
+                if not self._ready[node.id].is_set():
+                    self._fail(node, ProvisioningError(f"Could not poll instance {node.name}: {e}"))
+
+    def _poll_loop(self):
+        checks: dict[str, Future] = {}
+        retries = 0
+        with ThreadPoolExecutor(max_workers=8, thread_name_prefix="ready-check") as executor:
+            while True:
+                waiting = [node for node in self._nodes.values() if not self._ready[node.id].is_set()]
+                if not waiting:
+                    return
+                if time.monotonic() > self._deadline:
+                    for node in waiting:
+                        self._fail(node, TimeoutError(f"Instance {node.name} not ready after {self.timeout:g}s"))
+                    return
+
+                try:
+                    res = self.client.describe_instances(
+                        Filters=[{"Name": "instance-id", "Values": [node.id for node in waiting]}])
+                    retries = 0
+                except Exception as e:
+                    if not transient(e):
+                        raise
+                    retries += 1
+                    delay = min(self.poll_interval * 2 ** retries, MAX_RETRY_DELAY,
+                                max(0.0, self._deadline - time.monotonic()))
+                    logger.warning(f"Could not describe instances, retrying in {delay:g}s: {e}")
+                    time.sleep(delay)
+                    continue
+
+                states = {inst["InstanceId"]: inst for r in res["Reservations"] for inst in r["Instances"]}
+
+                for node in waiting:
+                    if node.id in states:
+                        self._update(node, states[node.id])
+                    if node.state in FAILED_STATES:
+                        self._fail(node, ProvisioningError(f"Instance {node.name} is {node.state}"))
+                    elif node.state == "running" and node.public_ip_address is not None:
+                        if self.ready_check is None:
+                            self._set_ready(node)
+                            continue
+                        check = checks.get(node.id)
+                        if check is not None and check.done():
+                            del checks[node.id]
+                            if check.exception() is None and check.result():
+                                self._set_ready(node)
+                                continue
+                        if node.id not in checks:
+                            checks[node.id] = executor.submit(self.ready_check, node)
+
+                time.sleep(self.poll_interval)
+
+    @staticmethod
+    def _update(node: Node, inst: dict) -> Node:
+        node.state = inst["State"]["Name"]
+        node.public_ip_address = inst.get("PublicIpAddress")
+        node.private_ip_address = inst.get("PrivateIpAddress")
+        return node
+
+    def _set_ready(self, node: Node):
+        logger.info(f"Instance {node.name} ({node.id}) is ready at {node.public_ip_address}")
+        self._ready[node.id].set()
+
+    def _fail(self, node: Node, error: Exception):
+        self._errors[node.id] = error
+        self._ready[node.id].set()
@@ -1,74 +1,84 @@
-import asyncio
 import logging
+import os
+from functools import partial
 
 import boto3
+from botocore.exceptions import ClientError
 from typing import TYPE_CHECKING
 
-from deploy.bench import run_benchmarks_standalone, run_benchmarks_cluster
-from deploy.instances import setup_mysql_single, setup_mysql_cluster_manager, setup_mysql_cluster_worker, \
-    post_setup_mysql_cluster, setup_gatekeeper, setup_proxy
+from deploy.artifacts import ARTIFACTS, MYSQL_CLUSTER_BUNDLE, MYSQL_CLUSTER_DATA_NODE, \
+    MYSQL_CLUSTER_MANAGEMENT_SERVER, SAKILA
+from deploy.bench import report, run_benchmarks_standalone, run_benchmarks_cluster
+from deploy.dag import DAG
+from deploy.instances import setup_mysql_single, setup_mysql_cluster_manager, setup_mysql_cluster_sql_node, \
+    setup_mysql_cluster_worker, start_mysql_cluster_worker, post_setup_mysql_cluster, setup_gatekeeper, setup_proxy, \
+    check_replicas
+from deploy.provision import CLUSTER_DATA_NODES, PROJECT_TAG, Provisioner, fleet
+from deploy.state import STATE
 
 if TYPE_CHECKING:
-    from mypy_boto3_ec2.service_resource import KeyPair, Vpc, SecurityGroup, Instance
+    from mypy_boto3_ec2.service_resource import KeyPair, KeyPairInfo, Vpc, SecurityGroup
 
 ec2_cli = boto3.client('ec2')
 ec2_res = boto3.resource('ec2')
 
 logger = logging.getLogger(__name__)
 
+# Setup steps running at the same time
+DEPLOY_CONCURRENCY = int(os.environ.get("DEPLOY_CONCURRENCY", "16"))
+
 
 async def setup():
+    # Before launching anything, the cluster could not start anyway
+    check_replicas(CLUSTER_DATA_NODES)
+
     vpc = get_default_vpc()
     key_pair = create_key_pair()
     security_group = create_security_group(vpc)
     availability_zone = get_availability_zones()[0]
 
-    instances: list['Instance'] = [
-        create_instance("mysql-standalone", "t2.micro", security_group, key_pair, availability_zone),
-        create_instance("mysql-cluster-manager", "t2.micro", security_group, key_pair, availability_zone),
-        create_instance("mysql-cluster-worker-1", "t2.micro", security_group, key_pair, availability_zone),
-        create_instance("mysql-cluster-worker-2", "t2.micro", security_group, key_pair, availability_zone),
-        create_instance("mysql-cluster-worker-3", "t2.micro", security_group, key_pair, availability_zone),
-        create_instance("proxy", "t2.large", security_group, key_pair, availability_zone),
-        create_instance("trusted-host", "t2.large", security_group, key_pair, availability_zone),
-        create_instance("gatekeeper", "t2.large", security_group, key_pair, availability_zone),
-    ]
-
-    logger.info("Waiting for instances to be running")
-
-    tasks = [asyncio.to_thread(wait_instance, inst) for inst in instances]
-    await asyncio.gather(*tasks)
-
-    logger.info("All instances are ready")
-    logger.info("Installing MySQL")
-
-    # Setup Single MySQL + Setup Cluster Manager + Setup gatekeeper/trusted-host/proxy simultaneously
-    tasks = [
-        asyncio.to_thread(setup_mysql_single, instances[0]),
-        asyncio.to_thread(setup_mysql_cluster_manager, instances[1], instances[2:5]),
-        asyncio.to_thread(setup_proxy, instances[5], instances[1], instances[2:5]),
-        asyncio.to_thread(setup_gatekeeper, instances[6], instances[5]),
-        asyncio.to_thread(setup_gatekeeper, instances[7], instances[6])
-    ]
-    await asyncio.gather(*tasks)
-
-    # Setup Cluster Workers
-    tasks = [
-        asyncio.to_thread(setup_mysql_cluster_worker, instances[1], inst, instances[2:5], instances[5]) for inst in
-        instances[2:5]
-    ]
-    await asyncio.gather(*tasks)
-
-    post_setup_mysql_cluster(instances[1])
-
-    # Benchmarks
-    tasks = [
-        asyncio.to_thread(run_benchmarks_standalone, instances[0].public_ip_address),
-        asyncio.to_thread(run_benchmarks_cluster, instances[1].public_ip_address)
-    ]
-    await asyncio.gather(*tasks)
-
-    return instances
+    provisioner = Provisioner(ec2_cli, key_pair.key_name, security_group.id, availability_zone)
+    topology = provisioner.launch(fleet(CLUSTER_DATA_NODES))
+    standalone, manager, workers, proxy, trusted_host, gatekeeper = (
+        topology.standalone, topology.manager, topology.workers, topology.proxy, topology.trusted_host,
+        topology.gatekeeper)
+
+    # Every step starts as soon as the ones it needs are done, instead of waiting for the slowest node of a phase
+    dag = DAG(max_concurrency=DEPLOY_CONCURRENCY)
+    # Every node is waited for by the same polling loop, each step only needs its own node to be ready
+    waits = {node.name: dag.add(f"wait {node.name}", partial(provisioner.wait, node)) for node in topology.nodes}
+    # Downloaded while the instances boot, the steps needing an artifact wait for its download to complete
+    for artifact in (MYSQL_CLUSTER_MANAGEMENT_SERVER, MYSQL_CLUSTER_DATA_NODE, MYSQL_CLUSTER_BUNDLE, SAKILA):
+        dag.add(f"fetch {artifact.filename}", partial(ARTIFACTS.fetch, artifact))
+
+    dag.add("setup mysql single", partial(setup_mysql_single, standalone), waits[standalone.name])
+    dag.add("run ndb_mgmd", partial(setup_mysql_cluster_manager, manager, workers), waits[manager.name])
+    dag.add("setup mysql cluster sql node", partial(setup_mysql_cluster_sql_node, manager), "run ndb_mgmd")
+    ndbds = []
+    for i, worker in enumerate(workers, start=1):
+        dag.add(f"setup worker {i}", partial(setup_mysql_cluster_worker, manager, worker, workers, proxy),
+                waits[worker.name])
+        # Data nodes register with the management node on startup
+        ndbds.append(dag.add(f"run ndbd {i}", partial(start_mysql_cluster_worker, worker),
+                             f"setup worker {i}", "run ndb_mgmd"))
+    dag.add("install sakila cluster", partial(post_setup_mysql_cluster, manager),
+            "setup mysql cluster sql node", *ndbds)
+
+    dag.add("build proxy", partial(setup_proxy, proxy, manager, workers), waits[proxy.name])
+    # The gatekeeper is the only forwarder of the trusted host, its address is needed for clients to be told apart
+    dag.add("build trusted-host", partial(setup_gatekeeper, trusted_host, proxy, (gatekeeper,)),
+            waits[trusted_host.name], waits[gatekeeper.name])
+    dag.add("build gatekeeper", partial(setup_gatekeeper, gatekeeper, trusted_host), waits[gatekeeper.name])
+
+    dag.add("benchmark standalone", lambda: run_benchmarks_standalone(standalone.public_ip_address),
+            "setup mysql single")
+    dag.add("benchmark cluster", lambda: run_benchmarks_cluster(manager.public_ip_address),
+            "install sakila cluster")
+    dag.add("benchmark report", report, "benchmark standalone", "benchmark cluster")
+
+    await dag.run()
+
+    return topology
 
 
 def get_default_vpc() -> 'Vpc':
@@ -80,20 +90,41 @@ def get_default_vpc() -> 'Vpc':
     return ec2_res.Vpc(vpcs['Vpcs'][0]['VpcId'])
 
 
-def create_key_pair() -> 'KeyPair':
+def create_key_pair() -> 'KeyPair | KeyPairInfo':
+    if STATE.resource('key_pair') == 'keypair' and os.path.exists('keypair.pem'):
+        key_pair = ec2_res.KeyPairInfo('keypair')
+        if exists(key_pair):
+            logger.info("Reusing key pair")
+            return key_pair
+
     logger.info("Creating key pair")
-    key_pair = ec2_res.create_key_pair(KeyName='keypair')
+    key_pair = ec2_res.create_key_pair(KeyName='keypair', TagSpecifications=[{
+        'ResourceType': 'key-pair',
+        'Tags': [PROJECT_TAG],
+    }])
     with open('keypair.pem', 'w') as f:
         f.write(key_pair.key_material)
+    STATE.set_resource('key_pair', key_pair.key_name)
     return key_pair
 
 
 def create_security_group(vpc: 'Vpc') -> 'SecurityGroup':
+    group_id = STATE.resource('security_group')
+    if group_id is not None:
+        group = ec2_res.SecurityGroup(group_id)
+        if exists(group):
+            logger.info("Reusing security group")
+            return group
+
     logger.info("Creating security group")
     group = ec2_res.create_security_group(
         GroupName='security_group',
         Description='security_group',
-        VpcId=vpc.id
+        VpcId=vpc.id,
+        TagSpecifications=[{
+            'ResourceType': 'security-group',
+            'Tags': [PROJECT_TAG],
+        }]
     )
     group.authorize_ingress(IpPermissions=[
         {
@@ -103,44 +134,18 @@ def create_security_group(vpc: 'Vpc') -> 'SecurityGroup':
             "IpRanges": [{"CidrIp": "0.0.0.0/0"}],
         }
     ])
+    STATE.set_resource('security_group', group.id)
     return group
 
 
-def create_instance(name: str, instance_type, security_group: 'SecurityGroup', key_pair: 'KeyPair',
-                    availability_zone: str) -> 'Instance':
-    logger.info(f"Creating instance {name}")
-    return ec2_res.create_instances(
-        KeyName=key_pair.key_name,
-        SecurityGroupIds=[security_group.id],
-        InstanceType=instance_type,
-        ImageId='ami-053b0d53c279acc90',
-        Placement={'AvailabilityZone': availability_zone},
-        MinCount=1,
-        MaxCount=1,
-        BlockDeviceMappings=[
-            {
-                'DeviceName': '/dev/sda1',
-                'Ebs': {
-                    'DeleteOnTermination': True,
-                    'VolumeSize': 15,
-                    'VolumeType': 'gp2',
-                }
-            }
-        ],
-        TagSpecifications=[{
-            'ResourceType': 'instance',
-            'Tags': [{
-                'Key': 'Name',
-                'Value': name,
-            }]
-        }]
-    )[0]
-
-
-def wait_instance(inst: 'Instance'):
-    logger.info(f"Waiting for {inst.id} to be running")
-    inst.wait_until_running()
-    inst.reload()
+def exists(resource) -> bool:
+    try:
+        resource.load()
+        return True
+    except ClientError as e:
+        if not e.response['Error']['Code'].endswith('NotFound'):
+            raise
+        return False
 
 
 def get_availability_zones():
@@ -0,0 +1,150 @@
+import logging
+import selectors
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from textwrap import dedent
+
+from paramiko.client import SSHClient, AutoAddPolicy
+from paramiko.pkey import PKey
+from paramiko.rsakey import RSAKey
+
+from deploy.state import STATE
+
+logger = logging.getLogger(__name__)
+
+KEY_FILE = "keypair.pem"
+USERNAME = "ubuntu"
+
+# Lines of output kept to report why a script failed
+ERROR_TAIL_LINES = 50
+
+
+class SSHExecError(RuntimeError):
+    pass
+
+
+@lru_cache
+def private_key(path: str = KEY_FILE) -> PKey:
+    return RSAKey.from_private_key_file(path)
+
+
+class SSHPool:
+    """
+    One SSH connection per host, opened on first use and shared by every step run against the host.
+    Steps run concurrently on the same host each get their own channel over the shared connection.
+    """
+
+    def __init__(self, username: str = USERNAME, key_file: str = KEY_FILE, port: int = 22):
+        self.username = username
+        self.key_file = key_file
+        self.port = port
+        self._clients: dict[str, SSHClient] = {}
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, host: str) -> SSHClient:
+        with self._lock:
+            lock = self._locks.setdefault(host, threading.Lock())
+        with lock:
+            cli = self._clients.get(host)
+            if cli is not None and cli.get_transport() is not None and cli.get_transport().is_active():
+                return cli
+            if cli is not None:
+                cli.close()
+
+            cli = SSHClient()
+            cli.set_missing_host_key_policy(AutoAddPolicy())
+            cli.connect(hostname=host, port=self.port, username=self.username, pkey=private_key(self.key_file),
+                        look_for_keys=False, allow_agent=False)
+            self._clients[host] = cli
+            return cli
+
+    def discard(self, host: str):
+        with self._lock:
+            cli = self._clients.pop(host, None)
+        if cli is not None:
+            cli.close()
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+        for cli in clients:
+            cli.close()
+
+
+SSH_POOL = SSHPool()
+
+
+@contextmanager
+def ssh_session(host: str, pool: SSHPool = SSH_POOL):
+    """
+    Pooled connection to the given host, dropped if it broke while in use
+    """
+    cli = pool.get(host)
+    try:
+        yield cli
+    except Exception:
+        transport = cli.get_transport()
+        if transport is None or not transport.is_active():
+            pool.discard(host)
+        raise
+
+
+def ssh_exec(name: str, cli: SSHClient, cmd: str, resumable: bool = True):
+    """
+    Run the script on the host, logging its output line by line as it is produced.
+    Resumable scripts already completed on the host by a previous deployment are skipped.
+    """
+    cmd = dedent(cmd)
+    key = STATE.step_key(cli.get_transport().getpeername()[0], name, cmd)
+    if resumable and STATE.done(key):
+        logger.info(f"Skipping script {name}, already completed")
+        return
+
+    logger.info(f"Executing script {name}")
+    logger.info(f"SSH >> {cmd}")
+
+    tail: deque[str] = deque(maxlen=ERROR_TAIL_LINES)
+    with cli.get_transport().open_session() as chan:
+        chan.get_pty()
+        chan.exec_command(cmd)
+
+        pending = {"out": b"", "err": b""}
+
+        def consume(stream: str, data: bytes):
+            *lines, pending[stream] = (pending[stream] + data).split(b"\n")
+            for line in lines:
+                emit(stream, line)
+
+        def emit(stream: str, line: bytes):
+            line = line.decode(errors="replace").rstrip("\r")
+            tail.append(line)
+            logger.info(f"{name} {stream} >> {line}")
+
+        # Reading as soon as data arrives keeps the channel window open, so the script never blocks on its output
+        with selectors.DefaultSelector() as selector:
+            selector.register(chan, selectors.EVENT_READ)
+            while True:
+                selector.select(timeout=1)
+                while chan.recv_ready():
+                    consume("out", chan.recv(32768))
+                while chan.recv_stderr_ready():
+                    consume("err", chan.recv_stderr(32768))
+                if chan.exit_status_ready() and not chan.recv_ready() and not chan.recv_stderr_ready():
+                    break
+
+        for stream, rest in pending.items():
+            if rest:
+                emit(stream, rest)
+        status = chan.recv_exit_status()
+
+    logger.info(f"Script {name} finished with status {status}")
+    if status != 0:
+        err = "\n".join(tail)
+        logger.error(f"SSH error >> {err}")
+        raise SSHExecError(err)
+    if resumable:
+        STATE.complete(key)
+
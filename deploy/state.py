@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import threading
+
+STATE_FILE = ".deploy-state.json"
+
+
+class DeploymentState:
+    """
+    What a previous deployment already did, persisted after every change so that an interrupted deployment can
+    be resumed: the AWS resources it created, and the scripts that completed on each host.
+
+    A script is identified by its host, its name and its rendered content. Changing anything in the script, such
+    as the address of another node or the hash of a file it uses, makes it run again.
+    """
+
+    def __init__(self, path: str = STATE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        self._resources: dict[str, str] = data.get("resources", {})
+        self._steps: set[str] = set(data.get("steps", []))
+
+    @staticmethod
+    def step_key(host: str, name: str, script: str) -> str:
+        return hashlib.sha256("\0".join((host, name, script)).encode()).hexdigest()
+
+    def done(self, key: str) -> bool:
+        with self._lock:
+            return key in self._steps
+
+    def complete(self, key: str):
+        with self._lock:
+            self._steps.add(key)
+            self._save()
+
+    def resource(self, name: str) -> str | None:
+        with self._lock:
+            return self._resources.get(name)
+
+    def resources(self, prefix: str = "") -> dict[str, str]:
+        with self._lock:
+            return {name: value for name, value in self._resources.items() if name.startswith(prefix)}
+
+    def set_resource(self, name: str, value: str):
+        with self._lock:
+            self._resources[name] = value
+            self._save()
+
+    def reset(self):
+        with self._lock:
+            self._resources.clear()
+            self._steps.clear()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _save(self):
+        tmp = f"{self.path}.part"
+        with open(tmp, "w") as f:
+            json.dump({"resources": self._resources, "steps": sorted(self._steps)}, f, indent=2)
+        os.replace(tmp, self.path)
+
+
+STATE = DeploymentState()
@@ -1,59 +1,139 @@
+import asyncio
 import logging
+import time
+from dataclasses import dataclass, field
+from functools import partial
 
 import backoff
 from botocore.exceptions import ClientError
 
-from deploy.setup import ec2_res
+from deploy.dag import DAG
+from deploy.provision import PROJECT_TAG
+from deploy.setup import ec2_cli
+from deploy.state import STATE
 
 logger = logging.getLogger(__name__)
 
+# Names given to the key pair and security group by deployments made before they were tagged
+KEY_NAMES = ("keypair",)
+GROUP_NAMES = ("security_group",)
 
-def destroy_instances():
-    logger.info("Terminating instances")
-    instances = ec2_res.instances.filter(
-        Filters=[{
-            'Name': 'instance-state-name',
-            'Values': ['pending', 'running']
-        }],
-    )
-    for inst in instances:
-        inst.terminate()
+# States of the instances still to be terminated
+LIVE_STATES = ["pending", "running", "stopping", "stopped", "shutting-down"]
 
 
-def destroy_keypair():
-    try:
-        logger.info("Deleting key pair")
-        pairs = ec2_res.key_pairs.filter(
-            KeyNames=["keypair"],
-        )
-        for pair in pairs:
-            pair.delete()
-            logger.info("Key pair deleted")
-    except ClientError as e:
-        if e.response['Error']['Code'] != 'InvalidKeyPair.NotFound':
-            raise
-        logger.error("Key pair not found")
-
-
-@backoff.on_exception(backoff.constant, ClientError)
-def destroy_security_group():
-    try:
-        logger.info("Deleting security group")
-        security_groups = ec2_res.security_groups.filter(
-            GroupNames=["security_group"],
+@dataclass
+class Resources:
+    instances: list[str] = field(default_factory=list)
+    key_pairs: list[str] = field(default_factory=list)
+    security_groups: list[str] = field(default_factory=list)
+
+
+def dependency_violation(e: ClientError) -> bool:
+    return e.response['Error']['Code'] == 'DependencyViolation'
+
+
+class Teardown:
+    """
+    Delete the resources of the deployment, found by their Project tag, along with the ones recorded in the
+    deployment state or named as by older deployments.
+
+    Every instance is terminated with a single call, and waited for by a single waiter. Key pairs are deleted
+    meanwhile, while security groups are deleted as soon as no instance uses them anymore.
+    """
+
+    def __init__(self, client, tag: dict = PROJECT_TAG, key_names=KEY_NAMES, group_names=GROUP_NAMES,
+                 waiter_delay: float = 5, waiter_max_attempts: int = 120):
+        self.client = client
+        self.tag = tag
+        self.key_names = list(key_names)
+        self.group_names = list(group_names)
+        self.waiter_delay = waiter_delay
+        self.waiter_max_attempts = waiter_max_attempts
+
+    def find(self) -> Resources:
+        tag_filter = {'Name': f"tag:{self.tag['Key']}", 'Values': [self.tag['Value']]}
+        state_filter = {'Name': 'instance-state-name', 'Values': LIVE_STATES}
+
+        instances = self._instances([tag_filter, state_filter])
+        known = list(STATE.resources("instance:").values())
+        if known:
+            instances |= self._instances([{'Name': 'instance-id', 'Values': known}, state_filter])
+
+        key_pairs = {pair['KeyName'] for filters in ([tag_filter], [{'Name': 'key-name', 'Values': self.key_names}])
+                     for pair in self.client.describe_key_pairs(Filters=filters)['KeyPairs']}
+
+        group_filters = [[tag_filter], [{'Name': 'group-name', 'Values': self.group_names}]]
+        if STATE.resource('security_group') is not None:
+            group_filters.append([{'Name': 'group-id', 'Values': [STATE.resource('security_group')]}])
+        security_groups = {group['GroupId'] for filters in group_filters
+                           for group in self.client.describe_security_groups(Filters=filters)['SecurityGroups']}
+
+        return Resources(sorted(instances), sorted(key_pairs), sorted(security_groups))
+
+    async def run(self, resources: Resources | None = None) -> DAG:
+        """
+        Delete the given resources, or the ones found, and log the time each step took
+        """
+        if resources is None:
+            start = time.perf_counter()
+            resources = self.find()
+            logger.info(f"Found {len(resources.instances)} instances, {len(resources.key_pairs)} key pairs and "
+                        f"{len(resources.security_groups)} security groups in {time.perf_counter() - start:.1f}s")
+
+        dag = DAG(max_concurrency=8)
+        waits = []
+        if resources.instances:
+            dag.add("terminate instances", partial(self.terminate, resources.instances))
+            waits.append(dag.add("wait instances terminated", partial(self.wait_terminated, resources.instances),
+                                 "terminate instances"))
+        for name in resources.key_pairs:
+            dag.add(f"delete key pair {name}", partial(self.delete_key_pair, name))
+        for group_id in resources.security_groups:
+            dag.add(f"delete security group {group_id}", partial(self.delete_security_group, group_id), *waits)
+
+        await dag.run()
+        return dag
+
+    def terminate(self, instance_ids: list[str]):
+        logger.info(f"Terminating instances {', '.join(instance_ids)}")
+        self.client.terminate_instances(InstanceIds=instance_ids)
+
+    def wait_terminated(self, instance_ids: list[str]):
+        self.client.get_waiter('instance_terminated').wait(
+            InstanceIds=instance_ids,
+            WaiterConfig={'Delay': self.waiter_delay, 'MaxAttempts': self.waiter_max_attempts},
         )
-        for sg in security_groups:
-            sg.delete()
-            logger.info("Security group deleted")
-    except ClientError as e:
-        if e.response['Error']['Code'] != 'InvalidGroup.NotFound':
-            raise
-        logger.info("Security group not found")
+
+    def delete_key_pair(self, name: str):
+        try:
+            self.client.delete_key_pair(KeyName=name)
+            logger.info(f"Key pair {name} deleted")
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidKeyPair.NotFound':
+                raise
+            logger.info(f"Key pair {name} not found")
+
+    # Network interfaces of terminated instances can take a few more seconds to be released
+    @backoff.on_exception(backoff.expo, ClientError, giveup=lambda e: not dependency_violation(e), max_time=120)
+    def delete_security_group(self, group_id: str):
+        try:
+            self.client.delete_security_group(GroupId=group_id)
+            logger.info(f"Security group {group_id} deleted")
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidGroup.NotFound':
+                raise
+            logger.info(f"Security group {group_id} not found")
+
+    def _instances(self, filters: list[dict]) -> set[str]:
+        paginator = self.client.get_paginator('describe_instances')
+        return {inst['InstanceId'] for page in paginator.paginate(Filters=filters)
+                for reservation in page['Reservations'] for inst in reservation['Instances']}
 
 
 def main():
-    destroy_instances()
-    destroy_keypair()
-    destroy_security_group()
+    asyncio.run(Teardown(ec2_cli).run())
+    # Nothing a previous deployment did is left to resume from
+    STATE.reset()
 
     logger.info("Environment destroyed")
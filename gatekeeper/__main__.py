@@ -1,12 +1,122 @@
 import logging
+import math
 import os
+import time
 
 import requests
-from flask import Flask, request
+from flask import Flask, Response, g, request
+from requests.adapters import HTTPAdapter
+
+from common.logs import RequestLog
+from common.metrics import Metrics
+from common.singleflight import SingleFlight
+from common.sql import READ, classify_fingerprint, deterministic, fingerprint, normalize
+from common.statement import is_json, parse_statement
+from gatekeeper.admission import Admission, Rejected
+from gatekeeper.firewall import DENY, Firewall
 
 app = Flask(__name__)
 
 PROXY_HOST = os.environ.get("PROXY_HOST")
+PORT = int(os.environ.get("PORT", "8080"))
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+
+# Keep-alive connections kept open to the upstream host
+UPSTREAM_POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", "32"))
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", "60"))
+# Bytes read from the upstream response before being relayed to the client
+RELAY_CHUNK_SIZE = int(os.environ.get("RELAY_CHUNK_SIZE", str(64 * 1024)))
+# Encodings the proxy streams results in, as negotiated by proxy.core.negotiate
+STREAMED_MIMETYPES = ["application/x-ndjson", "application/vnd.log8415.columnar"]
+
+# Headers only meaningful for a single connection, or set by each server, which must not be forwarded
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer", "trailers",
+    "transfer-encoding", "upgrade", "host", "content-length", "server", "date",
+}
+
+# JSON file holding the firewall rules, the defaults of gatekeeper.firewall are used if unset
+FIREWALL_RULES = os.environ.get("FIREWALL_RULES")
+FIREWALL_CACHE_SIZE = int(os.environ.get("FIREWALL_CACHE_SIZE", "4096"))
+
+FIREWALL = Firewall.from_file(FIREWALL_RULES, cache_size=FIREWALL_CACHE_SIZE)
+
+# Requests per second, and burst size, allowed per client and overall. 0 disables the limit.
+ADMISSION_CLIENT_RATE = float(os.environ.get("ADMISSION_CLIENT_RATE", "50"))
+ADMISSION_CLIENT_BURST = float(os.environ.get("ADMISSION_CLIENT_BURST", "100"))
+ADMISSION_GLOBAL_RATE = float(os.environ.get("ADMISSION_GLOBAL_RATE", "500"))
+ADMISSION_GLOBAL_BURST = float(os.environ.get("ADMISSION_GLOBAL_BURST", "1000"))
+# Requests forwarded to the upstream host at once, and requests allowed to wait for one of them to complete
+ADMISSION_MAX_CONCURRENT = int(os.environ.get("ADMISSION_MAX_CONCURRENT", str(UPSTREAM_POOL_SIZE)))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "64"))
+# Seconds a request waits in the queue before being answered 503
+ADMISSION_DEADLINE = float(os.environ.get("ADMISSION_DEADLINE", "0.5"))
+# Comma-separated addresses of gatekeepers in front of this one, whose X-Forwarded-For header identifies clients
+TRUSTED_FORWARDERS = {addr.strip() for addr in os.environ.get("TRUSTED_FORWARDERS", "").split(",") if addr.strip()}
+
+ADMISSION = Admission(client_rate=ADMISSION_CLIENT_RATE, client_burst=ADMISSION_CLIENT_BURST,
+                      global_rate=ADMISSION_GLOBAL_RATE, global_burst=ADMISSION_GLOBAL_BURST,
+                      max_concurrent=ADMISSION_MAX_CONCURRENT, queue_size=ADMISSION_QUEUE_SIZE,
+                      deadline=ADMISSION_DEADLINE)
+
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE))
+
+METRICS = Metrics()
+
+# Sampled records of the requests, and of the slow or failed ones, written in the background
+REQUESTS = RequestLog("gatekeeper.requests")
+
+# Identical reads in flight at the same time, forwarded only once
+FLIGHTS = SingleFlight()
+
+
+@app.route("/metrics", methods=["GET"])
+def handle_metrics():
+    """
+    Report request counts, error counts and latency percentiles, by route and phase, and the firewall, admission
+    and coalescing counters, and the state of the request log
+    """
+    return {**METRICS.snapshot(), "firewall": FIREWALL.stats(), "admission": ADMISSION.stats(),
+            "coalesced": FLIGHTS.stats(), "request_log": REQUESTS.stats()}
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def log_request(response: Response) -> Response:
+    """
+    Record the request once its response was sent, streamed bodies included
+    """
+    route = request.path.lstrip("/")
+    if route == "metrics":
+        return response
+    start, status, sql, origin = g.start, response.status_code, g.get("sql"), client()
+    response.call_on_close(lambda: REQUESTS.record(time.perf_counter() - start, error=status >= 500, route=route,
+                                                   status=status, client=origin, sql=sql))
+    return response
+
+
+@app.route("/batch", methods=["POST"])
+def handle_batch():
+    """
+    Forward a list of statements to the proxy in a single round-trip
+    """
+    statements = request.get_json(silent=True)
+    if isinstance(statements, dict):
+        statements = statements.get("statements")
+    if not isinstance(statements, list) or not all(isinstance(sql, str) for sql in statements):
+        return "Batch must be a list of SQL statements", 400
+
+    for i, sql in enumerate(statements):
+        if FIREWALL.check("batch", sql) == DENY:
+            app.logger.warning(f"Firewall denied statement {i} of batch")
+            return f"Statement {i} denied by firewall", 403
+
+    return forward("batch")
 
 
 @app.route("/<method>", methods=["GET", "POST"])
@@ -14,22 +124,150 @@ def handle(method: str):
     """
     Handle /direct, /random, and /custom requests
     """
-    app.logger.info(
-        f"Forwarding request to host '{PROXY_HOST}' with method '{method}' and data '{request.data.decode()}'")
+    try:
+        sql, _ = parse_statement(request.get_data(), request.content_type)
+    except ValueError as e:
+        return str(e), 400
+    g.sql = sql
+    if FIREWALL.check(method, sql) == DENY:
+        app.logger.warning(f"Firewall denied request with method '{method}'")
+        return "Denied by firewall", 403
+
+    fp = fingerprint(sql)
+    if classify_fingerprint(fp) == READ and deterministic(fp) and not streamed():
+        return coalesce(method, sql)
+    return forward(method)
+
+
+def streamed() -> bool:
+    """
+    Whether the client accepts a streamed encoding, whose response must be relayed as it arrives rather than shared
+    """
+    return request.accept_mimetypes.best_match(["text/html", *STREAMED_MIMETYPES]) in STREAMED_MIMETYPES
+
+
+def client() -> str:
+    """
+    Address of the client the request originates from
+    """
+    addr = request.remote_addr or ""
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if forwarded_for and addr in TRUSTED_FORWARDERS:
+        # Every forwarder appends the address it got the request from, so only the entries on the right, up to the
+        # first one not appended by a trusted forwarder, are not written by the client
+        for hop in reversed(forwarded_for.split(",")):
+            addr = hop.strip()
+            if addr not in TRUSTED_FORWARDERS:
+                break
+    return addr
+
 
-    url = f"http://{PROXY_HOST}/{method}"
+def coalesce(method: str, sql: str):
+    """
+    Forward the read, sharing a single upstream request with the identical reads received at the same time.
+    The shared response is read whole before being sent to each client, so only reads answered with a plain,
+    non-streamed response are coalesced.
+    """
+    try:
+        ADMISSION.limit(client())
+    except Rejected as e:
+        return shed(method, e)
+
+    # Parameterized statements are only identical if their parameters are too
+    body = request.get_data() if is_json(request.content_type) else normalize(sql)
+    key = (method, request.method, request.content_type, request.headers.get("Accept"), body)
+    try:
+        status, headers, content = FLIGHTS.do(key, fetch, method)
+    except Rejected as e:
+        return shed(method, e)
+    return Response(content, status=status, headers=headers)
+
+
+def fetch(method: str) -> tuple[int, list[tuple[str, str]], bytes]:
+    """
+    Forward the request to the upstream host, and return the status, headers and body of the response
+    """
+    ADMISSION.acquire()
+    start = time.perf_counter()
+    error = True
+    try:
+        with METRICS.time("phase", phase="forward", route=method):
+            with session.request(request.method, f"http://{PROXY_HOST}/{method}", data=request.get_data(),
+                                 headers=upstream_headers(), stream=True, timeout=UPSTREAM_TIMEOUT) as res:
+                content = res.raw.read(decode_content=False)
+        error = res.status_code >= 500
+        return res.status_code, downstream_headers(res), content
+    finally:
+        ADMISSION.release()
+        METRICS.observe("request", time.perf_counter() - start, error=error, route=method)
 
-    match request.method:
-        case "GET":
-            res = requests.get(url, data=request.data.decode())
-        case "POST":
-            res = requests.post(url, data=request.data.decode())
-        case _:
-            return "Method not allowed", 405
 
-    return res.content
+def shed(method: str, e: Rejected):
+    app.logger.warning(f"Shedding request with method '{method}' from '{client()}': {e.reason}")
+    METRICS.observe("shed", 0, route=method, status=e.status)
+    return e.reason, e.status, {"Retry-After": str(math.ceil(e.retry_after))}
+
+
+def forward(method: str):
+    """
+    Forward the request to the upstream host over a pooled keep-alive connection, and relay the response as it
+    arrives, with its status and headers. Requests over the rate limits, or which cannot be forwarded before the
+    admission deadline, are answered right away instead.
+    """
+    try:
+        with METRICS.time("phase", phase="admission", route=method):
+            ADMISSION.admit(client())
+    except Rejected as e:
+        return shed(method, e)
+
+    start = time.perf_counter()
+    try:
+        with METRICS.time("phase", phase="forward", route=method):
+            res = session.request(request.method, f"http://{PROXY_HOST}/{method}", data=request.get_data(),
+                                  headers=upstream_headers(), stream=True, timeout=UPSTREAM_TIMEOUT)
+    except Exception:
+        ADMISSION.release()
+        METRICS.observe("request", time.perf_counter() - start, error=True, route=method)
+        raise
+
+    headers = downstream_headers(res)
+    # Content-Length is only valid as long as the body is relayed byte for byte, which is the case here
+    if "Content-Length" in res.headers:
+        headers.append(("Content-Length", res.headers["Content-Length"]))
+    response = Response(relay(res, start, method), status=res.status_code, headers=headers)
+    # The upstream slot is held until the body was relayed, and given back even if the body was never started
+    response.call_on_close(ADMISSION.release)
+    return response
+
+
+def upstream_headers() -> dict[str, str]:
+    headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+    headers["X-Forwarded-For"] = ", ".join(filter(None, [request.headers.get("X-Forwarded-For"),
+                                                         request.remote_addr]))
+    return headers
+
+
+def downstream_headers(res: requests.Response) -> list[tuple[str, str]]:
+    return [(name, value) for name, value in res.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS]
+
+
+def relay(res: requests.Response, start: float, method: str):
+    """
+    Yield the upstream body as is, without decoding it, so that only one chunk at a time is held in memory
+    """
+    error = True
+    try:
+        yield from res.raw.stream(RELAY_CHUNK_SIZE, decode_content=False)
+        error = res.status_code >= 500
+    finally:
+        # Hands the connection back to the pool once the body was read, or drops it if the client went away
+        res.close()
+        METRICS.observe("request", time.perf_counter() - start, error=error, route=method)
 
 
 if __name__ == "__main__":
-    app.logger.setLevel(logging.DEBUG)
-    app.run(host="0.0.0.0", port=8080)
+    logging.basicConfig(level=LOG_LEVEL)
+    # Requests are logged by the request log, sampled and off the request path
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    REQUESTS.start()
+    app.run(host="0.0.0.0", port=PORT)
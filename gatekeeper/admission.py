@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """
+    Allow rate events per second on average, with bursts of up to burst events
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> bool:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self) -> float:
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class Rejected(Exception):
+    def __init__(self, status: int, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Admission:
+    """
+    Decide which requests get forwarded upstream, so that latency stays bounded when clients burst.
+
+    Requests are first rate limited, per client and globally, with token buckets, and answered 429 when over the
+    limit. Admitted requests then need one of max_concurrent slots toward the upstream host. When all are taken,
+    up to queue_size requests wait for one, for at most deadline seconds. Requests that cannot be queued or that
+    hit the deadline are answered 503. A rate or size of 0 disables the corresponding limit.
+    """
+
+    def __init__(self, client_rate: float = 0, client_burst: float = 0, global_rate: float = 0,
+                 global_burst: float = 0, max_concurrent: int = 0, queue_size: int = 0, deadline: float = 1.0,
+                 max_clients: int = 10000):
+        self.client_rate = client_rate
+        self.client_burst = client_burst or client_rate
+        self.max_concurrent = max_concurrent
+        self.queue_size = queue_size
+        self.deadline = deadline
+        self.max_clients = max_clients
+
+        self._global = TokenBucket(global_rate, global_burst or global_rate) if global_rate else None
+        self._clients: OrderedDict[str, TokenBucket] = OrderedDict()
+        self._lock = threading.Lock()
+        self._slots = threading.Condition(threading.Lock())
+        self._active = 0
+        self._waiting = 0
+
+        self._admitted = 0
+        self._shed = {"client_rate": 0, "global_rate": 0, "queue_full": 0, "deadline": 0}
+
+    def admit(self, client: str):
+        """
+        Take a slot for the request, or raise Rejected. Every admitted request must be released.
+        """
+        self.limit(client)
+        self.acquire()
+
+    def limit(self, client: str):
+        """
+        Take a token for the request from the buckets of the client and from the global one, or raise Rejected
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.client_rate:
+                bucket = self._clients.get(client)
+                if bucket is None:
+                    bucket = self._clients[client] = TokenBucket(self.client_rate, self.client_burst)
+                    if len(self._clients) > self.max_clients:
+                        # The least recently seen client is the one whose bucket most likely refilled completely
+                        self._clients.popitem(last=False)
+                else:
+                    self._clients.move_to_end(client)
+                if not bucket.take(now):
+                    self._shed["client_rate"] += 1
+                    raise Rejected(429, "Client rate limit exceeded", bucket.retry_after())
+
+            if self._global is not None and not self._global.take(now):
+                self._shed["global_rate"] += 1
+                raise Rejected(429, "Rate limit exceeded", self._global.retry_after())
+
+    def acquire(self):
+        """
+        Take one of the slots toward the upstream host, waiting for one until the deadline, or raise Rejected
+        """
+        if not self.max_concurrent:
+            self._count_admitted()
+            return
+
+        with self._slots:
+            if self._active < self.max_concurrent:
+                self._active += 1
+            elif self._waiting >= self.queue_size:
+                self._count_shed("queue_full")
+                raise Rejected(503, "Too many requests in flight", self.deadline)
+            else:
+                deadline = time.monotonic() + self.deadline
+                self._waiting += 1
+                try:
+                    while self._active >= self.max_concurrent:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._count_shed("deadline")
+                            raise Rejected(503, "Request could not be served in time", self.deadline)
+                        self._slots.wait(remaining)
+                finally:
+                    self._waiting -= 1
+                self._active += 1
+        self._count_admitted()
+
+    def release(self):
+        if not self.max_concurrent:
+            return
+        with self._slots:
+            self._active -= 1
+            self._slots.notify()
+
+    def stats(self) -> dict:
+        with self._slots:
+            active, waiting = self._active, self._waiting
+        with self._lock:
+            return {
+                "admitted": self._admitted,
+                "shed": dict(self._shed),
+                "active": active,
+                "waiting": waiting,
+                "clients": len(self._clients),
+            }
+
+    def _count_admitted(self):
+        with self._lock:
+            self._admitted += 1
+
+    def _count_shed(self, reason: str):
+        with self._lock:
+            self._shed[reason] += 1
@@ -0,0 +1,53 @@
+import itertools
+import timeit
+
+from common.sql import fingerprint
+from gatekeeper.firewall import DEFAULT_RULES, Firewall
+
+# Typical statements sent through the gatekeeper, with a placeholder for a literal that changes between requests
+STATEMENTS = [
+    ("custom", "SELECT * FROM film WHERE film_id = {}"),
+    ("random", "SELECT first_name, last_name FROM actor WHERE actor_id IN ({}, 2, 3)"),
+    ("direct", "UPDATE film SET rental_rate = 2.99 WHERE film_id = {}"),
+    ("auto", "SELECT f.title FROM film f JOIN film_actor fa ON f.film_id = fa.film_id WHERE fa.actor_id = {}"),
+]
+
+ROUNDS = 20000
+
+
+def bench(name: str, fn):
+    seconds = min(timeit.repeat(fn, number=ROUNDS, repeat=5))
+    print(f"{name:<36} {seconds / ROUNDS * 1e6:8.2f} µs/check")
+
+
+def main():
+    """
+    Measure the per-request overhead of the firewall, with and without its verdict caches
+    """
+    firewall = Firewall(DEFAULT_RULES)
+    counter = itertools.count()
+    identical = [(route, sql.format(1)) for route, sql in STATEMENTS]
+
+    def uncached():
+        # What every request would cost without the caches
+        route, sql = STATEMENTS[next(counter) % len(STATEMENTS)]
+        firewall._evaluate(route, fingerprint(sql.format(next(counter))))
+
+    def same_shape():
+        # Literals change on every request: the statement cache misses, the fingerprint cache hits
+        route, sql = STATEMENTS[next(counter) % len(STATEMENTS)]
+        firewall.check(route, sql.format(next(counter)))
+
+    def same_statement():
+        # The same statements over and over: a single lookup in the statement cache
+        route, sql = identical[next(counter) % len(identical)]
+        firewall.check(route, sql)
+
+    bench("rules evaluated on every request", uncached)
+    bench("fingerprint cache hit", same_shape)
+    bench("statement cache hit", same_statement)
+    print(firewall.stats())
+
+
+if __name__ == "__main__":
+    main()
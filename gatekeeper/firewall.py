@@ -0,0 +1,129 @@
+import json
+import re
+import threading
+from functools import lru_cache
+
+from common.sql import READ, classify_fingerprint, fingerprint, unresolved
+
+ALLOW = "allow"
+DENY = "deny"
+
+# Statements matching a deny rule are refused. Otherwise, a route with allow rules only accepts statements
+# matching one of them, and a route with deny rules only accepts the rest. Rules under "*" apply to every route,
+# and routes missing from the rules get the default verdict unless "*" has allow rules. Routes marked read_only
+# also refuse statements which are not reads, as told by the proxy routing them (common.sql.classify).
+# Rules are matched against fingerprints: upper-cased, literals replaced with ?, comments and extra whitespace
+# removed.
+DEFAULT_RULES = {
+    "default": DENY,
+    "routes": {
+        "*": {
+            "deny": [
+                r"^(?:DROP|TRUNCATE|GRANT|REVOKE|RENAME|SHUTDOWN|KILL|INSTALL|UNINSTALL|LOAD|FLUSH|RESET|PURGE)\b",
+                r"^(?:CREATE|ALTER|DROP|RENAME) USER\b",
+                r"^SET (?:PASSWORD|GLOBAL|PERSIST)\b",
+                r"\bINTO (?:OUTFILE|DUMPFILE)\b",
+                r"\b(?:LOAD_FILE|SLEEP|BENCHMARK) ?\(",
+                # Several statements at once
+                r";",
+            ],
+        },
+        "direct": {"allow": [r"."]},
+        "auto": {"allow": [r"."]},
+        "random": {"read_only": True, "allow": [r"."]},
+        "custom": {"read_only": True, "allow": [r"."]},
+        "batch": {"allow": [r"."]},
+        # Introspection routes of the proxy do not take any statement
+        "stats": {"allow": [r"^$"]},
+        "metrics": {"allow": [r"^$"]},
+    },
+}
+
+# Quotes and comment starts, only found in a fingerprint when left open, or inside quoted identifiers
+_OPENERS = re.compile(r"['\"`]|/\*")
+
+# Statements longer than this are not cached as is, only their fingerprint is
+RAW_CACHE_MAX_LENGTH = 512
+
+
+class Firewall:
+    """
+    Allow or deny SQL statements per route, from precompiled rules.
+
+    Verdicts are cached per fingerprint, and per raw statement for short ones, so that once warm, checking a
+    statement costs a single cache lookup.
+    """
+
+    def __init__(self, rules: dict, cache_size: int = 4096):
+        self.default = rules.get("default", DENY)
+        routes = rules.get("routes", {})
+        shared = routes.get("*", {})
+        self._deny = {route: self._compile([*shared.get("deny", []), *spec.get("deny", [])])
+                      for route, spec in routes.items() if route != "*"}
+        self._allow = {route: self._compile(spec.get("allow", []))
+                       for route, spec in routes.items() if route != "*"}
+        self._read_only = {route for route, spec in routes.items() if route != "*" and spec.get("read_only")}
+        self._shared_deny = self._compile(shared.get("deny", []))
+        self._shared_allow = self._compile(shared.get("allow", []))
+
+        self._by_statement = lru_cache(maxsize=cache_size)(self._check_statement)
+        self._by_fingerprint = lru_cache(maxsize=cache_size)(self._evaluate)
+        self._denied = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: str | None, cache_size: int = 4096) -> 'Firewall':
+        if not path:
+            return cls(DEFAULT_RULES, cache_size)
+        with open(path) as f:
+            return cls(json.load(f), cache_size)
+
+    def check(self, route: str, sql: str) -> str:
+        if len(sql) <= RAW_CACHE_MAX_LENGTH:
+            verdict = self._by_statement(route, sql)
+        else:
+            verdict = self._check_statement(route, sql)
+        if verdict == DENY:
+            with self._lock:
+                self._denied += 1
+        return verdict
+
+    def stats(self) -> dict:
+        with self._lock:
+            denied = self._denied
+        return {
+            "denied": denied,
+            "statement_cache": self._by_statement.cache_info()._asdict(),
+            "fingerprint_cache": self._by_fingerprint.cache_info()._asdict(),
+        }
+
+    def _check_statement(self, route: str, sql: str) -> str:
+        # MySQL runs the content of /*! ... */ comments, which fingerprints drop like any other comment
+        if "/*!" in sql:
+            return DENY
+        fp = fingerprint(sql)
+        # Quotes and comments left open could hide the rest of the statement from the rules, but not from MySQL.
+        # Closed ones never make it to the fingerprint, except inside identifiers.
+        if _OPENERS.search(fp) and unresolved(sql):
+            return DENY
+        return self._by_fingerprint(route, fp)
+
+    def _evaluate(self, route: str, fp: str) -> str:
+        known = route in self._allow
+        deny = self._deny[route] if known else self._shared_deny
+        if deny is not None and deny.search(fp):
+            return DENY
+        if route in self._read_only and classify_fingerprint(fp) != READ:
+            return DENY
+
+        allow = self._allow[route] if known else self._shared_allow
+        if allow is None:
+            return ALLOW if known else self.default
+        return ALLOW if allow.search(fp) else DENY
+
+    @staticmethod
+    def _compile(patterns: list[str]) -> re.Pattern | None:
+        # All the rules of a list are merged into a single alternation, matched in one pass
+        if not patterns:
+            return None
+        return re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
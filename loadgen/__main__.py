@@ -0,0 +1,104 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+from contextlib import nullcontext
+
+import requests
+from rich.logging import RichHandler
+
+from loadgen.chain import LocalChain
+from loadgen.runner import Result, Runner, Workload
+
+logger = logging.getLogger(__name__)
+
+
+def parse_routes(spec: str) -> dict[str, float]:
+    routes = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        route, _, weight = item.partition("=")
+        routes[route.strip()] = float(weight or 1)
+    return routes
+
+
+def fmt(value, spec: str) -> str:
+    return "-" if value is None else format(value, spec)
+
+
+def table(rows: list[dict], labels: list[str], seconds: float | None = None) -> str:
+    lines = [" ".join(f"{label:<8}" for label in labels)
+             + f" {'count':>8} {'errors':>7} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"]
+    for row in rows:
+        rps = row["count"] / seconds if seconds else None
+        lines.append(" ".join(f"{str(row.get(label, '-')):<8}" for label in labels)
+                     + f" {row['count']:>8} {row['errors']:>7} {fmt(rps, '.1f'):>9} {fmt(row['p50_ms'], '.2f'):>9} "
+                       f"{fmt(row['p95_ms'], '.2f'):>9} {fmt(row['p99_ms'], '.2f'):>9}")
+    return "\n".join(lines)
+
+
+def report(result: Result, chain: LocalChain | None) -> str:
+    """
+    Latencies seen by the clients, then, for local runs, the latencies seen by each service of the chain, the
+    difference between two hops being the overhead of the service in between
+    """
+    sections = [f"Client, over {result.seconds:.1f}s:\n" + table(result.report(), ["route", "kind"], result.seconds)]
+
+    statuses = ", ".join(f"/{route} {status}: {count}" for (route, status), count in sorted(
+        result.statuses.items(), key=str))
+    sections.append(f"Responses: {statuses}")
+
+    if chain is not None:
+        for name in ("gatekeeper", "trusted-host", "proxy"):
+            metrics = requests.get(f"{chain.url(name)}/metrics", timeout=5).json()
+            labels = ["route", "host"] if name == "proxy" else ["route"]
+            sections.append(f"{name}:\n" + table(metrics.get("request", []), labels, result.seconds))
+    return "\n\n".join(sections)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m loadgen", description="""
+        Send a mix of requests to the gatekeeper and report the throughput and latency percentiles of every route.
+        Without a target, the gatekeeper, trusted host and proxy are started locally, in front of SQLite-backed
+        stand-ins of the MySQL nodes.""")
+    parser.add_argument("--target", help="URL of a running gatekeeper, instead of a local chain")
+    parser.add_argument("--routes", default="direct=1,random=1,custom=1",
+                        help="relative share of the requests sent to each route (default: %(default)s)")
+    parser.add_argument("--write-ratio", type=float, default=0.1,
+                        help="share of the requests to /direct which are writes (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run for (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="workers sending requests, or most requests in flight with --rate "
+                             "(default: %(default)s)")
+    parser.add_argument("--rate", type=float,
+                        help="requests per second to send whatever the response times (open-loop), instead of each "
+                             "worker waiting for its previous response (closed-loop)")
+    parser.add_argument("--seed", type=int, help="seed of the request mix, for repeatable runs")
+    parser.add_argument("--latency", default="",
+                        help="latency added by the local stand-ins, in ms per host, as in "
+                             "'manager=5,slave-1=1,slave-2=1,slave-3=20', '*' setting the default")
+    parser.add_argument("--server", default="flask", choices=["flask", "async"],
+                        help="server of the local proxy (default: %(default)s)")
+    parser.add_argument("--logs-dir", help="where the local services write their logs (default: a temporary "
+                                           "directory)")
+    parser.add_argument("--json", help="file to write the client-side results to, as JSON")
+    args = parser.parse_args()
+
+    chain = None
+    if args.target is None:
+        chain = LocalChain(args.logs_dir or tempfile.mkdtemp(prefix="loadgen-"), args.latency, args.server)
+
+    with chain or nullcontext():
+        workload = Workload(parse_routes(args.routes), args.write_ratio)
+        runner = Runner(args.target or chain.target, workload, args.concurrency, args.rate, seed=args.seed)
+        result = runner.run(args.duration)
+        print(report(result, chain))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"seconds": result.seconds, "routes": result.report()}, f, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), handlers=[RichHandler()])
+    main()
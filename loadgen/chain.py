@@ -0,0 +1,118 @@
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Root of the repository, the services are started from it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Hosts the proxy is told to connect to, only used by the stand-ins to pick the latency to add
+STANDIN_HOSTS = {
+    "MANAGER_HOST": "manager",
+    "SLAVE_1_HOST": "slave-1",
+    "SLAVE_2_HOST": "slave-2",
+    "SLAVE_3_HOST": "slave-3",
+}
+
+# Limits of the gatekeeper meant for real clients, while every request of the load generator comes from the same
+# address. They stay in place when set in the environment.
+UNLIMITED_ADMISSION = {
+    "ADMISSION_CLIENT_RATE": "0",
+    "ADMISSION_GLOBAL_RATE": "0",
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LocalChain:
+    """
+    The gatekeeper, trusted host and proxy apps run as local processes, chained as they are once deployed, with
+    the proxy connected to SQLite-backed stand-ins of the MySQL nodes
+    """
+
+    def __init__(self, logs_dir: str, latency: str = "", server: str = "flask"):
+        self.logs_dir = logs_dir
+        self.latency = latency
+        self.server = server
+        self.ports: dict[str, int] = {}
+        self._processes: list[tuple[str, subprocess.Popen]] = []
+
+    @property
+    def target(self) -> str:
+        return f"http://127.0.0.1:{self.ports['gatekeeper']}"
+
+    def url(self, name: str) -> str:
+        return f"http://127.0.0.1:{self.ports[name]}"
+
+    def __enter__(self):
+        os.makedirs(self.logs_dir, exist_ok=True)
+        try:
+            self.ports["proxy"] = self._spawn("proxy", "proxy", {
+                **STANDIN_HOSTS,
+                "PROXY_CONNECTOR": "loadgen.standin:connect",
+                "PROXY_SERVER": self.server,
+                "PROXY_DEBUG": "0",
+                "STANDIN_LATENCY_MS": self.latency,
+                "STANDIN_DATABASE": os.path.join(self.logs_dir, "standin.db"),
+            })
+            self.ports["trusted-host"] = self._spawn("trusted-host", "gatekeeper", {
+                "PROXY_HOST": f"127.0.0.1:{self.ports['proxy']}",
+                "TRUSTED_FORWARDERS": "127.0.0.1",
+            })
+            self.ports["gatekeeper"] = self._spawn("gatekeeper", "gatekeeper", {
+                "PROXY_HOST": f"127.0.0.1:{self.ports['trusted-host']}",
+            })
+            for name in self.ports:
+                self._wait_ready(name)
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stop(self):
+        for name, process in reversed(self._processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                logger.warning(f"Killing {name}, still running after being asked to stop")
+                process.kill()
+        self._processes.clear()
+
+    def _spawn(self, name: str, module: str, env: dict[str, str]) -> int:
+        port = free_port()
+        env = {**UNLIMITED_ADMISSION, **os.environ, **env, "PORT": str(port)}
+        log = open(os.path.join(self.logs_dir, f"{name}.log"), "w")
+        with log:
+            process = subprocess.Popen([sys.executable, "-m", module], cwd=ROOT, env=env, stdout=log,
+                                       stderr=subprocess.STDOUT)
+        self._processes.append((name, process))
+        logger.info(f"Started {name} on port {port}, logging to {log.name}")
+        return port
+
+    def _wait_ready(self, name: str, timeout: float = 30):
+        deadline = time.monotonic() + timeout
+        process = next(process for n, process in self._processes if n == name)
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{name} exited with code {process.returncode}, see {self.logs_dir}/{name}.log")
+            try:
+                if requests.get(f"{self.url(name)}/metrics", timeout=1).ok:
+                    return
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.1)
+        raise TimeoutError(f"{name} not ready after {timeout:g}s, see {self.logs_dir}/{name}.log")
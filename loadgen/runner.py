@@ -0,0 +1,144 @@
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.metrics import Metrics
+from loadgen.standin import ACTORS, FILMS
+
+logger = logging.getLogger(__name__)
+
+READ = "read"
+WRITE = "write"
+
+# Routes only accepting reads, writes are always sent to /direct
+READ_ONLY_ROUTES = {"random", "custom"}
+
+
+@dataclass
+class Workload:
+    # Relative share of the requests sent to each route
+    routes: dict[str, float] = field(default_factory=lambda: {"direct": 1, "random": 1, "custom": 1})
+    # Share of the requests to /direct which are writes
+    write_ratio: float = 0.1
+    # Range of the ids queried, a small range makes the result cache of the proxy hit more often
+    actors: int = ACTORS
+    films: int = FILMS
+
+    def next(self, rng: random.Random) -> tuple[str, str, str]:
+        """
+        Pick the route, the kind and the statement of the next request
+        """
+        route = rng.choices(list(self.routes), weights=list(self.routes.values()))[0]
+        if route not in READ_ONLY_ROUTES and rng.random() < self.write_ratio:
+            actor = rng.randint(1, self.actors)
+            return route, WRITE, f"UPDATE actor SET last_update = CURRENT_TIMESTAMP WHERE actor_id = {actor}"
+
+        match rng.randrange(3):
+            case 0:
+                return route, READ, f"SELECT * FROM actor WHERE actor_id = {rng.randint(1, self.actors)}"
+            case 1:
+                start = rng.randint(1, self.films)
+                return route, READ, f"SELECT film_id, title FROM film WHERE film_id BETWEEN {start} AND {start + 20}"
+            case _:
+                return route, READ, (f"SELECT COUNT(*) FROM film WHERE rental_rate = "
+                                     f"{rng.choice([0.99, 2.99, 4.99])}")
+
+
+@dataclass
+class Result:
+    seconds: float
+    metrics: Metrics
+    statuses: Counter
+
+    def report(self) -> list[dict]:
+        """
+        Throughput, error count and latency percentiles per route and kind of request
+        """
+        rows = []
+        for entry in self.metrics.snapshot().get("request", []):
+            rows.append({**entry, "rps": entry["count"] / self.seconds if self.seconds > 0 else 0.0})
+        return rows
+
+
+class Runner:
+    """
+    Send the workload to the gatekeeper, either closed-loop, with each worker sending its next request as soon as
+    the previous one was answered, or open-loop, with requests sent at a fixed rate whatever the response times.
+
+    In open-loop mode, latencies are measured from the time each request was scheduled, so that requests delayed
+    by a saturated system are accounted for.
+    """
+
+    def __init__(self, target: str, workload: Workload, concurrency: int = 8, rate: float | None = None,
+                 timeout: float = 30, seed: int | None = None):
+        self.target = target.rstrip("/")
+        self.workload = workload
+        self.concurrency = concurrency
+        self.rate = rate
+        self.timeout = timeout
+        self.seed = seed
+
+        self.metrics = Metrics()
+        self.statuses: Counter = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def run(self, duration: float) -> Result:
+        mode = f"open-loop at {self.rate:g} req/s" if self.rate else f"closed-loop with {self.concurrency} workers"
+        logger.info(f"Sending load to {self.target} for {duration:g}s, {mode}")
+        start = time.perf_counter()
+        if self.rate:
+            self._open_loop(start + duration)
+        else:
+            self._closed_loop(start + duration)
+        return Result(time.perf_counter() - start, self.metrics, self.statuses)
+
+    def _closed_loop(self, deadline: float):
+        def worker(i: int):
+            rng = random.Random(None if self.seed is None else self.seed + i)
+            while time.perf_counter() < deadline:
+                self._send(*self.workload.next(rng), time.perf_counter())
+
+        threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _open_loop(self, deadline: float):
+        rng = random.Random(self.seed)
+        interval = 1 / self.rate
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            scheduled = time.perf_counter()
+            while scheduled < deadline:
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self._send, *self.workload.next(rng), scheduled)
+                scheduled += interval
+
+    def _send(self, route: str, kind: str, sql: str, scheduled: float):
+        status = None
+        try:
+            res = self._session().post(f"{self.target}/{route}", data=sql, headers={"Content-Type": "text/plain"},
+                                       timeout=self.timeout)
+            status = res.status_code
+        except requests.RequestException as e:
+            logger.debug(f"Request to /{route} failed: {e}")
+        self.metrics.observe("request", time.perf_counter() - scheduled, error=status != 200, route=route, kind=kind)
+        with self._lock:
+            self.statuses[(route, status or "error")] += 1
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        return session
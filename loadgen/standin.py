@@ -0,0 +1,137 @@
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Database shared by every stand-in connection, whatever host they are opened to, created on first use
+STANDIN_DATABASE = os.environ.get("STANDIN_DATABASE") or os.path.join(tempfile.gettempdir(), "loadgen-standin.db")
+# Latency added to every statement, in milliseconds, per host, as in "manager=2,slave-1=1". "*" sets the default.
+STANDIN_LATENCY_MS = os.environ.get("STANDIN_LATENCY_MS", "")
+# Random part of the added latency, as a ratio of it
+STANDIN_JITTER = float(os.environ.get("STANDIN_JITTER", "0.2"))
+
+# Every error of SQLite is about the statement, the connection is kept by the proxy's pools
+STATEMENT_ERRORS = (sqlite3.Error,)
+
+ACTORS = 200
+FILMS = 1000
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def parse_latencies(spec: str) -> dict[str, float]:
+    latencies = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        host, _, ms = item.partition("=")
+        latencies[host.strip()] = float(ms) / 1000
+    return latencies
+
+
+LATENCIES = parse_latencies(STANDIN_LATENCY_MS)
+
+
+def connect(host: str, database: str | None = None, autocommit: bool = True, **_) -> 'Connection':
+    """
+    Open a connection to the stand-in database, answering like a MySQL connection would, as slow as configured
+    for the host
+    """
+    init()
+    return Connection(host, autocommit)
+
+
+def init(path: str = STANDIN_DATABASE, reset: bool = False):
+    """
+    Create the tables of the stand-in database, with a slice of the sakila schema and generated rows
+    """
+    global _initialized
+    with _init_lock:
+        if _initialized and not reset:
+            return
+        db = sqlite3.connect(path)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript("""
+                DROP TABLE IF EXISTS actor;
+                DROP TABLE IF EXISTS film;
+                CREATE TABLE actor (
+                    actor_id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, last_update TEXT
+                );
+                CREATE TABLE film (
+                    film_id INTEGER PRIMARY KEY, title TEXT, release_year INTEGER, rental_rate REAL,
+                    last_update TEXT
+                );
+            """)
+            rng = random.Random(8415)
+            db.executemany("INSERT INTO actor VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+                           [(i, f"FIRST{i}", f"LAST{rng.randrange(ACTORS)}") for i in range(1, ACTORS + 1)])
+            db.executemany("INSERT INTO film VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                           [(i, f"FILM {i}", 2006, rng.choice([0.99, 2.99, 4.99])) for i in range(1, FILMS + 1)])
+            db.commit()
+        finally:
+            db.close()
+        _initialized = True
+
+
+class Connection:
+    def __init__(self, host: str, autocommit: bool):
+        self.host = host
+        self.latency = LATENCIES.get(host, LATENCIES.get("*", 0.0))
+        self._db = sqlite3.connect(STANDIN_DATABASE, timeout=30, check_same_thread=False,
+                                   isolation_level=None if autocommit else "DEFERRED")
+        self._open = True
+
+    def cursor(self, prepared: bool = False) -> 'Cursor':
+        return Cursor(self)
+
+    def is_connected(self) -> bool:
+        return self._open
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._open = False
+        self._db.close()
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency * (1 + random.uniform(-STANDIN_JITTER, STANDIN_JITTER)))
+
+
+class Cursor:
+    def __init__(self, conn: Connection):
+        self._conn = conn
+        self._cursor = conn._db.cursor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def with_rows(self) -> bool:
+        return self._cursor.description is not None
+
+    def execute(self, sql: str, params: tuple | None = None):
+        self._conn.delay()
+        if params is None:
+            self._cursor.execute(sql)
+        else:
+            self._cursor.execute(sql.replace("%s", "?"), params)
+
+    def fetchall(self) -> list[tuple]:
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size: int) -> list[tuple]:
+        return self._cursor.fetchmany(size)
+
+    def close(self):
+        self._cursor.close()
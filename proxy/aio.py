@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from common.statement import parse_statement
+from proxy import core
+
+logger = logging.getLogger(__name__)
+
+# Threads running the blocking MySQL calls. Requests beyond this wait on the event loop, not in a thread.
+AIO_WORKERS = int(os.environ.get("AIO_WORKERS", "64"))
+# Connections idle for longer than this are closed
+AIO_KEEPALIVE_TIMEOUT = float(os.environ.get("AIO_KEEPALIVE_TIMEOUT", "75"))
+AIO_MAX_BODY_SIZE = int(os.environ.get("AIO_MAX_BODY_SIZE", str(16 * 1024 * 1024)))
+
+executor = ThreadPoolExecutor(max_workers=AIO_WORKERS, thread_name_prefix="proxy-aio")
+
+
+class HTTPError(Exception):
+    def __init__(self, status: HTTPStatus, message: str = ""):
+        super().__init__(message or status.phrase)
+        self.status = status
+
+
+async def serve(host: str, port: int):
+    """
+    Serve the proxy routes on an asyncio event loop, offloading the MySQL calls to a bounded thread pool
+    """
+    server = await asyncio.start_server(handle_connection, host, port, limit=64 * 1024)
+    logger.info(f"Serving asynchronously on {host}:{port} with {AIO_WORKERS} worker threads")
+    async with server:
+        await server.serve_forever()
+
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            try:
+                request = await asyncio.wait_for(read_request(reader), AIO_KEEPALIVE_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                break
+            except HTTPError as e:
+                await write_response(writer, e.status, "text/plain", str(e).encode(), keep_alive=False)
+                break
+            if request is None:
+                break
+
+            method, path, version, headers, body = request
+            keep_alive = keep_connection_alive(version, headers)
+            await dispatch(writer, method, path, headers, body, keep_alive)
+            if not keep_alive:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def read_request(reader: asyncio.StreamReader):
+    line = await read_line(reader, HTTPStatus.REQUEST_URI_TOO_LONG)
+    if not line:
+        return None
+    try:
+        method, path, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST)
+
+    headers = {}
+    while True:
+        line = await read_line(reader, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding", "identity").lower() != "identity":
+        raise HTTPError(HTTPStatus.LENGTH_REQUIRED)
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+    if length < 0:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+    if length > AIO_MAX_BODY_SIZE:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+    body = await reader.readexactly(length) if length else b""
+    return method, path.split("?", 1)[0], version, headers, body
+
+
+async def read_line(reader: asyncio.StreamReader, too_long: HTTPStatus) -> bytes:
+    try:
+        return await reader.readline()
+    except ValueError:
+        # Longer than the limit of the reader
+        raise HTTPError(too_long)
+
+
+def keep_connection_alive(version: str, headers: dict) -> bool:
+    connection = headers.get("connection", "").lower()
+    if version == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+
+async def dispatch(writer: asyncio.StreamWriter, method: str, path: str, headers: dict, body: bytes,
+                   keep_alive: bool):
+    loop = asyncio.get_running_loop()
+    route = path.strip("/")
+
+    # Same answers as the Flask app for the routes it only serves with a single method
+    allowed = {"stats": "GET", "metrics": "GET", "batch": "POST"}.get(route)
+    if allowed is not None and method != allowed:
+        await write_response(writer, HTTPStatus.METHOD_NOT_ALLOWED, "text/plain", b"Method not allowed", keep_alive)
+        return
+
+    if route == "stats":
+        stats = await loop.run_in_executor(executor, core.stats)
+        await write_response(writer, HTTPStatus.OK, "application/json", json.dumps(stats).encode(), keep_alive)
+        return
+
+    if route == "metrics":
+        metrics = await loop.run_in_executor(executor, core.metrics)
+        await write_response(writer, HTTPStatus.OK, "application/json", json.dumps(metrics).encode(), keep_alive)
+        return
+
+    if route == "batch":
+        try:
+            statements = core.parse_batch(body)
+        except ValueError as e:
+            await write_response(writer, HTTPStatus.BAD_REQUEST, "text/plain", str(e).encode(), keep_alive)
+            return
+        results = await loop.run_in_executor(executor, core.batch, statements)
+        await write_response(writer, HTTPStatus.OK, "application/json", json.dumps({"results": results}).encode(),
+                             keep_alive)
+        return
+
+    if route not in core.ROUTES:
+        await write_response(writer, HTTPStatus.NOT_FOUND, "text/plain", b"Not found", keep_alive)
+        return
+    if method not in ("GET", "POST"):
+        await write_response(writer, HTTPStatus.METHOD_NOT_ALLOWED, "text/plain", b"Method not allowed", keep_alive)
+        return
+
+    try:
+        sql, params = parse_statement(body, headers.get("content-type"))
+        core.check_statement(sql)
+    except ValueError as e:
+        await write_response(writer, HTTPStatus.BAD_REQUEST, "text/plain", str(e).encode(), keep_alive)
+        return
+
+    encoder = core.negotiate(headers.get("accept"))
+    try:
+        res = await loop.run_in_executor(executor, core.handle, route, sql, params, encoder)
+        if isinstance(res, str):
+            await write_response(writer, HTTPStatus.OK, "text/html; charset=utf-8", res.encode(), keep_alive)
+        else:
+            await write_stream(writer, res, encoder.mimetype, keep_alive)
+    except ConnectionError:
+        raise
+    except Exception as e:
+        logger.exception(f"Error while handling /{route}: {e}")
+        await write_response(writer, HTTPStatus.INTERNAL_SERVER_ERROR, "text/plain", b"Internal server error",
+                             keep_alive)
+
+
+async def write_response(writer: asyncio.StreamWriter, status: HTTPStatus, content_type: str, body: bytes,
+                         keep_alive: bool):
+    writer.write(head(status, content_type, keep_alive, [f"Content-Length: {len(body)}"]) + body)
+    await writer.drain()
+
+
+async def write_stream(writer: asyncio.StreamWriter, chunks, content_type: str, keep_alive: bool):
+    """
+    Write the chunks with chunked transfer encoding, pulling each one from the blocking generator in the thread
+    pool. Draining the writer between chunks keeps a slow client from piling up data in memory.
+    """
+    loop = asyncio.get_running_loop()
+    started = False
+    try:
+        while (chunk := await loop.run_in_executor(executor, next, chunks, None)) is not None:
+            if not started:
+                writer.write(head(HTTPStatus.OK, content_type, keep_alive, ["Transfer-Encoding: chunked"]))
+                started = True
+            if chunk:
+                writer.write(f"{len(chunk):X}\r\n".encode() + chunk + b"\r\n")
+                await writer.drain()
+    except Exception:
+        await loop.run_in_executor(executor, chunks.close)
+        if started:
+            # Headers are gone already, the only way to signal the error is to cut the response short
+            raise ConnectionError("Stream aborted")
+        raise
+
+    if not started:
+        writer.write(head(HTTPStatus.OK, content_type, keep_alive, ["Transfer-Encoding: chunked"]))
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+def head(status: HTTPStatus, content_type: str, keep_alive: bool, extra: list[str]) -> bytes:
+    lines = [
+        f"HTTP/1.1 {status.value} {status.phrase}",
+        f"Content-Type: {content_type}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        *extra,
+    ]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
@@ -0,0 +1,85 @@
+from flask import Flask, Response, request
+
+from common.statement import parse_statement
+from proxy import core
+
+app = Flask(__name__)
+
+
+@app.route("/direct", methods=["GET", "POST"])
+def handle_direct():
+    """
+    Directly send the request to the master node
+    """
+    return respond("direct")
+
+
+@app.route("/random", methods=["GET", "POST"])
+def handle_random():
+    """
+    Send the request to a random slave node
+    """
+    return respond("random")
+
+
+@app.route("/custom", methods=["GET", "POST"])
+def handle_custom():
+    """
+    Send the request to the slave with the least load
+    """
+    return respond("custom")
+
+
+@app.route("/auto", methods=["GET", "POST"])
+def handle_auto():
+    """
+    Send writes to the master node, and spread reads across the slaves
+    """
+    return respond("auto")
+
+
+@app.route("/batch", methods=["POST"])
+def handle_batch():
+    """
+    Run a list of statements, reads in parallel across the slaves and writes in order on the master node
+    """
+    try:
+        statements = core.parse_batch(request.data)
+    except ValueError as e:
+        return str(e), 400
+    return {"results": core.batch(statements)}
+
+
+@app.route("/stats", methods=["GET"])
+def handle_stats():
+    """
+    Report the state of the connection pools, of the balancer, and of the classifier, result and prepared
+    statement caches
+    """
+    return core.stats()
+
+
+@app.route("/metrics", methods=["GET"])
+def handle_metrics():
+    """
+    Report request counts, error counts and latency percentiles, by route, backend host and phase
+    """
+    return core.metrics()
+
+
+def respond(route: str):
+    """
+    Send the request to the host picked for the route, streaming the response back if the client accepts a
+    streamed encoding
+    """
+    try:
+        sql, params = parse_statement(request.get_data(), request.content_type)
+        core.check_statement(sql)
+    except ValueError as e:
+        return str(e), 400
+
+    encoder = core.negotiate(request.headers.get("Accept"))
+    res = core.handle(route, sql, params, encoder)
+    if isinstance(res, str):
+        return res
+    return Response(res, mimetype=encoder.mimetype)
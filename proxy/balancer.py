@@ -0,0 +1,398 @@
+import logging
+import math
+import random
+import statistics
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable
+
+# Exceptions which count as a failure of the backend, by default any of them
+Failures = tuple[type[BaseException], ...]
+
+logger = logging.getLogger(__name__)
+
+# Latency charged to a backend whose probe failed, so that it gets avoided until it recovers
+PROBE_FAILURE_PENALTY = 5.0
+
+# Number of recent query latencies the hedging delay is computed from
+LATENCY_WINDOW = 1000
+# Minimum weight of a backend being re-admitted, so that it gets some traffic to prove itself healthy again
+MIN_WEIGHT = 0.1
+# Hedges the budget can save up while reads are fast, to be spent on a burst of slow ones
+HEDGE_BURST = 10
+
+
+class Backend:
+    def __init__(self, host: str):
+        self.host = host
+        self.ewma: float | None = None
+        # Only fed by probes, whose cost does not depend on the queries clients send
+        self.probe_ewma: float | None = None
+        self.in_flight = 0
+        self.completed = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.probes = 0
+        self.probe_failures = 0
+        # Probes averaged into probe_ewma, which starts over on each ejection
+        self.probe_samples = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.readmitted_at: float | None = None
+        # Set once the host left the backends, it then only completes the queries already sent to it
+        self.draining = False
+
+    def score(self) -> float:
+        # Expected time to serve one more query: outstanding queries plus the new one, times their latency.
+        # Backends without any sample yet score 0 so that they get tried first.
+        return (self.ewma or 0.0) * (self.in_flight + 1)
+
+    def ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def weight(self, now: float, ramp: float) -> float:
+        """
+        Share of its normal traffic the backend receives, growing linearly back to 1 once re-admitted
+        """
+        if self.readmitted_at is None:
+            return 1.0
+        progress = (now - self.readmitted_at) / ramp if ramp > 0 else 1.0
+        if progress >= 1:
+            self.readmitted_at = None
+            return 1.0
+        return max(MIN_WEIGHT, progress)
+
+
+class Balancer:
+    """
+    Pick the least loaded backend from latency and in-flight statistics, without any I/O on the request path.
+
+    Backends failing too many queries in a row, or answering probes much slower than the others, are ejected
+    from the rotation for a while, twice as long on each ejection until they stayed healthy for eject_reset_time.
+    Being slow takes both eject_latency_factor times the median probe latency of the others and eject_latency_gap
+    seconds more than it, over at least eject_min_probes probes, so that the jitter of fast probes is not enough.
+    Once the ejection is over, their share of the traffic ramps up back to normal over a few seconds. At most
+    max_ejected_ratio of the backends are ejected at once. Only the exceptions listed in failures count as errors
+    of the backend, others are the client's own doing.
+
+    Backends can be added and drained at any time. A draining backend is no longer picked nor probed, and is only
+    removed once the queries it was running completed.
+    """
+
+    def __init__(self, hosts: list[str], policy: str = "p2c", alpha: float = 0.3, eject_errors: int = 3,
+                 eject_latency_factor: float = 5.0, eject_latency_gap: float = 0.02, eject_min_probes: int = 5,
+                 eject_time: float = 10.0, eject_max_time: float = 300.0, eject_reset_time: float = 60.0,
+                 max_ejected_ratio: float = 0.5, ramp_time: float = 10.0, hedge_percentile: float = 0,
+                 hedge_budget: float = 5.0, failures: Failures = (Exception,)):
+        if policy not in ("p2c", "least_outstanding"):
+            raise ValueError(f"Unknown balancing policy '{policy}'")
+        self.policy = policy
+        self.alpha = alpha
+        self.eject_errors = eject_errors
+        self.eject_latency_factor = eject_latency_factor
+        self.eject_latency_gap = eject_latency_gap
+        self.eject_min_probes = eject_min_probes
+        self.eject_time = eject_time
+        self.eject_max_time = eject_max_time
+        self.eject_reset_time = eject_reset_time
+        self.max_ejected_ratio = max_ejected_ratio
+        self.ramp_time = ramp_time
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.failures = failures
+
+        self.backends = {host: Backend(host) for host in hosts}
+        self._lock = threading.Lock()
+        self._prober: threading.Thread | None = None
+        self._stop = threading.Event()
+
+        self._latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._samples = 0
+        self._hedge_delay: float | None = None
+        self._hedge_tokens = 0.0
+        self._hedges = 0
+        self._hedges_won = 0
+
+    def __contains__(self, host: str) -> bool:
+        return host in self.backends
+
+    def add(self, host: str):
+        """
+        Start sending queries to the host, or stop draining it if it was
+        """
+        with self._lock:
+            backend = self.backends.get(host)
+            if backend is None:
+                self.backends[host] = Backend(host)
+                logger.info(f"Adding host '{host}'")
+            elif backend.draining:
+                backend.draining = False
+                logger.info(f"Host '{host}' is back, no longer draining it")
+
+    def drain(self, host: str):
+        """
+        Stop sending queries to the host, the ones in flight complete normally
+        """
+        with self._lock:
+            backend = self.backends.get(host)
+            if backend is not None and not backend.draining:
+                backend.draining = True
+                logger.info(f"Draining host '{host}', {backend.in_flight} queries in flight")
+
+    def reap(self) -> list[str]:
+        """
+        Remove the draining backends without any query in flight, and return their hosts
+        """
+        with self._lock:
+            drained = [b.host for b in self.backends.values() if b.draining and b.in_flight == 0]
+            for host in drained:
+                del self.backends[host]
+        return drained
+
+    def hosts(self) -> list[str]:
+        with self._lock:
+            return [b.host for b in self.backends.values() if not b.draining]
+
+    def choose(self, exclude: str | None = None) -> str | None:
+        candidates, weights = self._candidates(exclude)
+        if not candidates:
+            return None
+
+        if self.policy == "least_outstanding":
+            return min(candidates, key=lambda b: (b.in_flight / weights[b.host], b.ewma or 0.0)).host
+
+        # Power of two choices: compare two distinct random backends, drawn according to their weight, and keep the best
+        if len(candidates) == 1:
+            return candidates[0].host
+        a, b = self._pick_two(candidates, weights)
+        return a.host if a.score() <= b.score() else b.host
+
+    def choose_random(self) -> str | None:
+        candidates, weights = self._candidates(None)
+        if not candidates:
+            return None
+        return random.choices(candidates, weights=[weights[c.host] for c in candidates])[0].host
+
+    @contextmanager
+    def track(self, host: str):
+        """
+        Account a query sent to the given host for the duration of the block
+        """
+        with self._lock:
+            backend = self.backends.get(host)
+            if backend is not None:
+                backend.in_flight += 1
+        if backend is None:
+            # Removed since it was picked, the query is not accounted for
+            yield
+            return
+        start = time.perf_counter()
+        error: BaseException | None = None
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            with self._lock:
+                backend.in_flight -= 1
+                backend.completed += 1
+                self._observe(backend, latency, isinstance(error, self.failures))
+                if error is None:
+                    self._record_latency(latency)
+
+    def observe(self, host: str, latency: float, failed: bool = False):
+        with self._lock:
+            backend = self.backends.get(host)
+            if backend is not None:
+                self._observe(backend, latency, failed)
+
+    def hedge_delay(self) -> float | None:
+        """
+        Time after which a read still running deserves a duplicate on another backend, or None if hedging is off
+        or there is not enough history yet
+        """
+        return self._hedge_delay
+
+    def budget_hedge(self) -> bool:
+        """
+        Count a read which may be hedged, each one adding hedge_budget percent of a hedge to the budget, and tell
+        whether a hedge is left to spend on it
+        """
+        with self._lock:
+            self._hedge_tokens = min(HEDGE_BURST, self._hedge_tokens + self.hedge_budget / 100)
+            return self._hedge_tokens >= 1
+
+    def take_hedge(self) -> bool:
+        """
+        Spend a hedge of the budget, if one is left
+        """
+        with self._lock:
+            if self._hedge_tokens < 1:
+                return False
+            self._hedge_tokens -= 1
+            return True
+
+    def hedged(self, won: bool):
+        with self._lock:
+            self._hedges += 1
+            self._hedges_won += won
+
+    def start_prober(self, probe: Callable[[str], None], interval: float = 1.0):
+        """
+        Periodically time the given probe against every backend, in a background thread
+        """
+        if self._prober is not None:
+            return
+        self._stop.clear()
+        self._prober = threading.Thread(target=self._probe_loop, args=(probe, interval), daemon=True,
+                                        name="balancer-prober")
+        self._prober.start()
+
+    def stop_prober(self):
+        self._stop.set()
+        if self._prober is not None:
+            self._prober.join()
+            self._prober = None
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "hedge_delay_ms": None if self._hedge_delay is None else self._hedge_delay * 1000,
+                "hedges": self._hedges,
+                "hedges_won": self._hedges_won,
+                "backends": [
+                    {
+                        "host": b.host,
+                        "ewma_ms": None if b.ewma is None else b.ewma * 1000,
+                        "probe_ewma_ms": None if b.probe_ewma is None else b.probe_ewma * 1000,
+                        "in_flight": b.in_flight,
+                        "completed": b.completed,
+                        "errors": b.errors,
+                        "probes": b.probes,
+                        "probe_failures": b.probe_failures,
+                        "ejections": b.ejections,
+                        "ejected": b.ejected(now),
+                        "draining": b.draining,
+                        "weight": 0.0 if b.ejected(now) else b.weight(now, self.ramp_time),
+                    }
+                    for b in self.backends.values()
+                ]
+            }
+
+    def _candidates(self, exclude: str | None) -> tuple[list[Backend], dict[str, float]]:
+        now = time.monotonic()
+        candidates = []
+        weights = {}
+        with self._lock:
+            for backend in self.backends.values():
+                if backend.host == exclude or backend.draining or backend.ejected(now):
+                    continue
+                candidates.append(backend)
+                weights[backend.host] = backend.weight(now, self.ramp_time)
+        if not candidates and exclude is None:
+            # Never refuse to route, even if everything looks bad
+            candidates = [backend for backend in self.backends.values() if not backend.draining]
+            weights = {backend.host: 1.0 for backend in candidates}
+        return candidates, weights
+
+    @staticmethod
+    def _pick_two(candidates: list[Backend], weights: dict[str, float]) -> tuple[Backend, Backend]:
+        """
+        Draw two distinct backends, each with a probability proportional to its weight
+        """
+        a = random.choices(candidates, weights=[weights[c.host] for c in candidates])[0]
+        rest = [c for c in candidates if c is not a]
+        b = random.choices(rest, weights=[weights[c.host] for c in rest])[0]
+        return a, b
+
+    def _observe(self, backend: Backend, latency: float, failed: bool):
+        backend.ewma = self._average(backend.ewma, latency)
+
+        if backend.ejections and time.monotonic() - backend.ejected_until >= self.eject_reset_time:
+            # Healthy for long enough since its last ejection, the next one is short again
+            backend.ejections = 0
+
+        if failed:
+            backend.errors += 1
+            backend.consecutive_errors += 1
+        else:
+            backend.consecutive_errors = 0
+
+        if backend.consecutive_errors >= self.eject_errors:
+            self._eject(backend, f"{backend.consecutive_errors} consecutive errors")
+        elif self._is_slow(backend):
+            self._eject(backend, f"probe latency of {backend.probe_ewma * 1000:.1f}ms")
+
+    def _average(self, ewma: float | None, latency: float) -> float:
+        if ewma is None:
+            return latency
+        return ewma + self.alpha * (latency - ewma)
+
+    def _is_slow(self, backend: Backend) -> bool:
+        if backend.probe_ewma is None or backend.probe_samples < self.eject_min_probes:
+            return False
+        others = [b.probe_ewma for b in self.backends.values()
+                  if b is not backend and not b.draining and b.probe_ewma is not None]
+        if not others:
+            return False
+        median = statistics.median(others)
+        return (backend.probe_ewma > self.eject_latency_factor * median
+                and backend.probe_ewma - median > self.eject_latency_gap)
+
+    def _eject(self, backend: Backend, reason: str):
+        now = time.monotonic()
+        if backend.ejected(now):
+            return
+        active = [b for b in self.backends.values() if not b.draining]
+        ejected = sum(b.ejected(now) for b in active)
+        if ejected + 1 > math.floor(len(active) * self.max_ejected_ratio):
+            return
+
+        duration = min(self.eject_time * 2 ** backend.ejections, self.eject_max_time)
+        backend.ejections += 1
+        backend.ejected_until = now + duration
+        backend.readmitted_at = backend.ejected_until
+        backend.consecutive_errors = 0
+        # Start from a clean slate once re-admitted, its old latency would get it ejected right away
+        backend.ewma = None
+        backend.probe_ewma = None
+        backend.probe_samples = 0
+        logger.warning(f"Ejecting host '{backend.host}' for {duration:.0f}s after {reason}")
+
+    def _record_latency(self, latency: float):
+        if not self.hedge_percentile:
+            return
+        self._latencies.append(latency)
+        self._samples += 1
+        # Recomputing the percentile takes a sort of the whole window, only do it every now and then
+        if len(self._latencies) >= 20 and self._samples % 20 == 0:
+            ranked = sorted(self._latencies)
+            self._hedge_delay = ranked[min(len(ranked) - 1, int(len(ranked) * self.hedge_percentile / 100))]
+
+    def _probe_loop(self, probe: Callable[[str], None], interval: float):
+        while not self._stop.wait(interval):
+            for host in self.hosts():
+                start = time.perf_counter()
+                try:
+                    probe(host)
+                    latency = time.perf_counter() - start
+                    failed = False
+                except Exception as e:
+                    logger.warning(f"Probe of host '{host}' failed: {e}")
+                    latency = PROBE_FAILURE_PENALTY
+                    failed = True
+                with self._lock:
+                    backend = self.backends.get(host)
+                    if backend is None:
+                        continue
+                    backend.probes += 1
+                    backend.probe_failures += failed
+                    backend.probe_ewma = self._average(backend.probe_ewma, latency)
+                    backend.probe_samples += 1
+                    self._observe(backend, latency, failed)
@@ -0,0 +1,138 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from common.sql import deterministic
+
+
+class Entry:
+    __slots__ = ("value", "size", "expires", "tables")
+
+    def __init__(self, value, size: int, expires: float, tables: frozenset[str]):
+        self.value = value
+        self.size = size
+        self.expires = expires
+        self.tables = tables
+
+
+class ResultCache:
+    """
+    LRU cache of query results bounded in memory, whose entries expire after a TTL or as soon as one of the
+    tables they were read from gets written to.
+
+    Writes are only seen when they go through the proxy, and a view or a trigger hides the tables it touches,
+    so the TTL bounds how stale a result can get in those cases.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: OrderedDict[tuple, Entry] = OrderedDict()
+        self._by_table: dict[str, set[tuple]] = {}
+        # Bumped on every write to a table, to detect results read while the table was being written to
+        self._versions: dict[str, int] = {}
+        # Bumped on every write to unknown tables, which may be any of them
+        self._epoch = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def cacheable(fingerprint: str) -> bool:
+        return deterministic(fingerprint)
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            if entry.expires < time.monotonic():
+                self._remove(key)
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry.value
+
+    def snapshot(self, tables: frozenset[str]) -> tuple:
+        """
+        Versions of the given tables, to pass to put() once the result has been read
+        """
+        with self._lock:
+            return self._epoch, *(self._versions.get(table, 0) for table in sorted(tables))
+
+    def put(self, key: tuple, value, tables: frozenset[str], snapshot: tuple):
+        size = sys.getsizeof(value) + sum(sys.getsizeof(part) for part in key)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            # A write went through while the result was being read, it may already be stale
+            if snapshot != (self._epoch, *(self._versions.get(table, 0) for table in sorted(tables))):
+                return
+
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = Entry(value, size, time.monotonic() + self.ttl, tables)
+            self._bytes += size
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._evictions += 1
+
+    def invalidate(self, tables: frozenset[str]):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+                for key in list(self._by_table.get(table, ())):
+                    self._remove(key)
+                    self._invalidations += 1
+
+    def clear(self):
+        """
+        Drop every entry, after a write whose tables are unknown
+        """
+        with self._lock:
+            self._epoch += 1
+            self._invalidations += len(self._entries)
+            self._entries.clear()
+            self._by_table.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+                "invalidations": self._invalidations,
+            }
+
+    def _remove(self, key: tuple):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        for table in entry.tables:
+            keys = self._by_table[table]
+            keys.discard(key)
+            if not keys:
+                del self._by_table[table]
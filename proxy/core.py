@@ -0,0 +1,645 @@
+import importlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from common.logs import RequestLog
+from common.metrics import Metrics
+from common.singleflight import SingleFlight
+from common.sql import WRITE, changes_session, classify, classify_fingerprint, fingerprint, normalize, \
+    tables_fingerprint
+from proxy.balancer import Balancer
+from proxy.cache import ResultCache
+from proxy.encoding import ENCODERS
+from proxy.pool import ConnectionPool, PoolExhaustedError
+from proxy.prepared import StatementCache
+
+logger = logging.getLogger(__name__)
+
+METRICS = Metrics()
+
+# Sampled records of the requests, and of the slow or failed ones, written in the background
+REQUESTS = RequestLog("proxy.requests")
+
+# JSON file listing the backends, as {"manager": host, "slaves": [host, ...]}, reloaded whenever it changes.
+# The MANAGER_HOST and SLAVE_<n>_HOST variables are used if unset.
+BACKENDS_FILE = os.environ.get("BACKENDS_FILE")
+BACKENDS_RELOAD_INTERVAL = float(os.environ.get("BACKENDS_RELOAD_INTERVAL", "2"))
+
+
+def load_backends() -> tuple[str, list[str]]:
+    """
+    Read the manager and slave hosts from the backends file, or from the environment
+    """
+    if not BACKENDS_FILE:
+        slaves = []
+        for i in itertools.count(1):
+            host = os.environ.get(f"SLAVE_{i}_HOST")
+            if not host:
+                break
+            slaves.append(host)
+        return os.environ.get("MANAGER_HOST"), slaves
+
+    with open(BACKENDS_FILE) as f:
+        backends = json.load(f)
+    if not isinstance(backends, dict) or not isinstance(backends.get("manager"), str):
+        raise ValueError("Backends must be an object with a 'manager' host")
+    slaves = backends.get("slaves", [])
+    if not isinstance(slaves, list) or not all(isinstance(host, str) for host in slaves):
+        raise ValueError("Slaves must be a list of hosts")
+    return backends["manager"], slaves
+
+
+MANAGER_HOST, SLAVE_HOSTS = load_backends()
+
+POOL_MIN_SIZE = int(os.environ.get("POOL_MIN_SIZE", "1"))
+POOL_MAX_SIZE = int(os.environ.get("POOL_MAX_SIZE", "10"))
+POOL_IDLE_TIMEOUT = float(os.environ.get("POOL_IDLE_TIMEOUT", "300"))
+POOL_WAIT_TIMEOUT = float(os.environ.get("POOL_WAIT_TIMEOUT", "5"))
+# Function opening connections to the backends, as "module:function", MySQL Connector/Python is used if unset
+PROXY_CONNECTOR = os.environ.get("PROXY_CONNECTOR")
+
+
+def load_connector(spec: str | None):
+    if not spec:
+        from mysql.connector import connect
+        return connect
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+def load_errors(spec: str | None, kind: str) -> tuple[type[Exception], ...]:
+    """
+    Exceptions of the connector raised when the backend itself fails ("backend"), or only the statement sent to it
+    ("statement"). Other connectors list them in BACKEND_ERRORS and STATEMENT_ERRORS attributes of their module.
+    """
+    if not spec:
+        from mysql.connector import errors
+        match kind:
+            case "backend":
+                return errors.InterfaceError, errors.OperationalError
+            case "statement":
+                return errors.ProgrammingError, errors.DataError, errors.IntegrityError, errors.NotSupportedError
+    return tuple(getattr(importlib.import_module(spec.partition(":")[0]), f"{kind.upper()}_ERRORS", ()))
+
+
+CONNECTOR = load_connector(PROXY_CONNECTOR)
+# A client sending a bad statement must not get a healthy backend ejected, nor its connection closed
+BACKEND_ERRORS = (PoolExhaustedError, *load_errors(PROXY_CONNECTOR, "backend"))
+STATEMENT_ERRORS = load_errors(PROXY_CONNECTOR, "statement")
+
+
+def create_pool(host: str) -> ConnectionPool:
+    return ConnectionPool(
+        host,
+        min_size=POOL_MIN_SIZE,
+        max_size=POOL_MAX_SIZE,
+        idle_timeout=POOL_IDLE_TIMEOUT,
+        wait_timeout=POOL_WAIT_TIMEOUT,
+        connector=CONNECTOR,
+        reusable_errors=STATEMENT_ERRORS,
+        user="ubuntu",
+        password="ubuntu",
+        database="sakila",
+        autocommit=True
+    )
+
+
+_backends_lock = threading.Lock()
+
+
+class BackendRemoved(LookupError):
+    """
+    The host left the backends and was reaped between being picked for a query and being sent it
+    """
+
+# Pools of hosts which left the backends stay here until the queries they were running completed
+POOLS = {host: create_pool(host) for host in [MANAGER_HOST, *SLAVE_HOSTS]}
+
+BALANCER_POLICY = os.environ.get("BALANCER_POLICY", "p2c")
+BALANCER_PROBE_INTERVAL = float(os.environ.get("BALANCER_PROBE_INTERVAL", "1"))
+
+# A slave failing this many queries or probes in a row, or answering probes this many times slower than the
+# others, is ejected from the rotation for EJECT_TIME seconds, doubled on each ejection up to EJECT_MAX_TIME
+EJECT_ERRORS = int(os.environ.get("EJECT_ERRORS", "3"))
+EJECT_LATENCY_FACTOR = float(os.environ.get("EJECT_LATENCY_FACTOR", "5"))
+# Being slow also takes probes this many milliseconds slower than the others, averaged over EJECT_MIN_PROBES
+EJECT_LATENCY_GAP_MS = float(os.environ.get("EJECT_LATENCY_GAP_MS", "20"))
+EJECT_MIN_PROBES = int(os.environ.get("EJECT_MIN_PROBES", "5"))
+EJECT_TIME = float(os.environ.get("EJECT_TIME", "10"))
+EJECT_MAX_TIME = float(os.environ.get("EJECT_MAX_TIME", "300"))
+# Seconds a slave must stay healthy after an ejection for the next one to last EJECT_TIME again
+EJECT_RESET_TIME = float(os.environ.get("EJECT_RESET_TIME", "60"))
+# Seconds over which a re-admitted slave gets back to its full share of the traffic
+EJECT_RAMP_TIME = float(os.environ.get("EJECT_RAMP_TIME", "10"))
+
+# Percentile of the read latency after which a duplicate read is sent to another slave, 0 to disable hedging
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "0"))
+# Percentage of the slave reads which may get a duplicate
+HEDGE_BUDGET = float(os.environ.get("HEDGE_BUDGET", "5"))
+HEDGE_WORKERS = int(os.environ.get("HEDGE_WORKERS", "32"))
+
+BALANCER = Balancer(
+    SLAVE_HOSTS,
+    policy=BALANCER_POLICY,
+    eject_errors=EJECT_ERRORS,
+    eject_latency_factor=EJECT_LATENCY_FACTOR,
+    eject_latency_gap=EJECT_LATENCY_GAP_MS / 1000,
+    eject_min_probes=EJECT_MIN_PROBES,
+    eject_time=EJECT_TIME,
+    eject_max_time=EJECT_MAX_TIME,
+    eject_reset_time=EJECT_RESET_TIME,
+    ramp_time=EJECT_RAMP_TIME,
+    hedge_percentile=HEDGE_PERCENTILE,
+    hedge_budget=HEDGE_BUDGET,
+    failures=BACKEND_ERRORS,
+)
+
+hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="proxy-hedge")
+# Threads of hedge_executor not running a read, taken before submitting one so that none waits in its queue
+hedge_slots = threading.BoundedSemaphore(HEDGE_WORKERS)
+
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", "30"))
+
+CACHE = ResultCache(max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL)
+# Statements sent to the master node without changing any table, which leave the cache as is. The other session
+# statements are refused by check_statement().
+SESSION_KEYWORDS = {"COMMIT", "ROLLBACK"}
+
+# Prepared statements kept per connection
+PREPARED_CACHE_SIZE = int(os.environ.get("PREPARED_CACHE_SIZE", "64"))
+
+STATEMENTS = StatementCache(max_size=PREPARED_CACHE_SIZE)
+
+# Identical reads in flight at the same time, executed only once
+FLIGHTS = SingleFlight()
+
+# Number of rows fetched at once when streaming a result
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", "500"))
+
+# Strategy used by /auto to spread reads across the slaves, either "random" or "custom"
+AUTO_READ_STRATEGY = os.environ.get("AUTO_READ_STRATEGY", "custom")
+
+# Threads running the reads of a /batch request in parallel
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", "16"))
+BATCH_MAX_STATEMENTS = int(os.environ.get("BATCH_MAX_STATEMENTS", "100"))
+
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="proxy-batch")
+
+ROUTES = ("direct", "random", "custom", "auto")
+
+
+def resolve(route: str, sql: str) -> str:
+    """
+    Pick the host the request must be sent to, depending on the route it came from
+    """
+    match route:
+        case "direct":
+            return MANAGER_HOST
+        case "random" | "custom":
+            return choose_slave(route)
+        case "auto":
+            if classify(sql) == WRITE:
+                return MANAGER_HOST
+            return choose_slave(AUTO_READ_STRATEGY)
+        case _:
+            raise ValueError(f"Unknown route '{route}'")
+
+
+def handle(route: str, sql: str, params: tuple | None, encoder):
+    """
+    Send the request to the host picked for the route, and return either the whole response, or a generator
+    streaming it if an encoder is given. Parameterized statements are always answered in one piece.
+    """
+    start = time.perf_counter()
+    host = None
+    try:
+        host = resolve(route, sql)
+        if encoder is None or params is not None:
+            try:
+                res = send_hedged(host, sql, params)
+            except BackendRemoved:
+                # Nothing was sent, the host was reaped right after being picked
+                host = resolve(route, sql)
+                res = send_hedged(host, sql, params)
+            elapsed = time.perf_counter() - start
+            METRICS.observe("request", elapsed, route=route, host=host)
+            REQUESTS.record(elapsed, route=route, host=host, sql=sql)
+            return res
+        try:
+            chunks = stream(host, sql, encoder)
+        except BackendRemoved:
+            host = resolve(route, sql)
+            chunks = stream(host, sql, encoder)
+        return observe_stream(chunks, start, route, host, sql)
+    except Exception:
+        elapsed = time.perf_counter() - start
+        METRICS.observe("request", elapsed, error=True, route=route, host=host)
+        REQUESTS.record(elapsed, error=True, route=route, host=host, sql=sql)
+        raise
+
+
+def observe_stream(chunks, start: float, route: str, host: str, sql: str):
+    error = True
+    try:
+        yield from chunks
+        error = False
+    finally:
+        elapsed = time.perf_counter() - start
+        METRICS.observe("request", elapsed, error=error, route=route, host=host)
+        REQUESTS.record(elapsed, error=error, route=route, host=host, sql=sql, streamed=True)
+
+
+def choose_slave(strategy: str) -> str:
+    """
+    Pick a slave node using the given strategy, or the manager if there are no slaves
+    """
+    match strategy:
+        case "random":
+            return BALANCER.choose_random() or MANAGER_HOST
+        case "custom":
+            return BALANCER.choose() or MANAGER_HOST
+        case _:
+            raise ValueError(f"Unknown strategy '{strategy}'")
+
+
+def check_statement(sql: str):
+    """
+    Refuse statements leaving state on the pooled connection they run on, which would leak into the requests of
+    other clients
+    """
+    if changes_session(fingerprint(sql)):
+        raise ValueError("Statements changing the session, such as USE, SET or START TRANSACTION, are not supported")
+
+
+def negotiate(accept: str | None):
+    """
+    Return the streaming encoder matching the Accept header, or None if the client expects a plain response
+    """
+    mimetype = parse_accept_header(accept, MIMEAccept).best_match(["text/html", *ENCODERS])
+    return ENCODERS.get(mimetype)
+
+
+def send(host: str, sql: str, params: tuple | None = None, coalesce: bool = True):
+    """
+    Send the request to the given host and return the response, going through the result cache.
+    When parameters are given, the SQL command is a template run as a server-side prepared statement.
+    Identical reads sent at the same time share a single execution, unless coalesce is False.
+    """
+    fp = fingerprint(sql)
+    if classify_fingerprint(fp) == WRITE:
+        try:
+            return execute(host, sql, params)
+        finally:
+            invalidate(fp)
+
+    # Each execution of a non-deterministic read is expected to give a different result
+    if not CACHE.cacheable(fp):
+        return execute(host, sql, params)
+
+    key = ("manager" if host == MANAGER_HOST else "slave", normalize(sql), params)
+    if CACHE.enabled:
+        res = CACHE.get(key)
+        if res is not None:
+            return res
+
+    tables = tables_fingerprint(fp)
+    if not coalesce:
+        return fetch(host, sql, params, key, tables)
+    return FLIGHTS.do(key, fetch, host, sql, params, key, tables)
+
+
+def fetch(host: str, sql: str, params: tuple | None, key: tuple, tables: frozenset[str]):
+    """
+    Run a read on the given host and store its result in the cache
+    """
+    if not CACHE.enabled:
+        return execute(host, sql, params)
+
+    snapshot = CACHE.snapshot(tables)
+    res = execute(host, sql, params)
+    CACHE.put(key, res, tables, snapshot)
+    return res
+
+
+def invalidate(fp: str):
+    """
+    Drop the cached results the write may have changed, all of them when the tables it writes to are unknown, as
+    for CALL, unless it only changes the state of the session
+    """
+    if not CACHE.enabled:
+        return
+    tables = tables_fingerprint(fp)
+    if tables:
+        CACHE.invalidate(tables)
+    elif fp.partition(" ")[0] not in SESSION_KEYWORDS:
+        CACHE.clear()
+
+
+def send_hedged(host: str, sql: str, params: tuple | None = None):
+    """
+    Send the request to the given host, and if it is a read to a slave that takes longer than usual, send it to
+    a second slave as well, returning whichever answers first.
+
+    A read can only be overtaken when it runs apart from the calling thread, so it runs on the calling thread
+    unless a hedge is left in the budget and a thread of hedge_executor is free. The duplicate is only sent if a
+    second one is free by then.
+    """
+    delay = BALANCER.hedge_delay()
+    if delay is None or host not in BALANCER or classify(sql) == WRITE:
+        return send(host, sql, params)
+    if not BALANCER.budget_hedge() or not hedge_slots.acquire(blocking=False):
+        return send(host, sql, params)
+
+    primary = hedge_executor.submit(in_slot, send, host, sql, params)
+    done, _ = wait([primary], timeout=delay)
+    other = None if done else BALANCER.choose(exclude=host)
+    if other is None or not hedge_slots.acquire(blocking=False):
+        return primary.result()
+    if not BALANCER.take_hedge():
+        hedge_slots.release()
+        return primary.result()
+
+    # The duplicate must not wait on the very read it is meant to overtake
+    secondary = hedge_executor.submit(in_slot, send, other, sql, params, coalesce=False)
+    pending = {primary, secondary}
+    while True:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        succeeded = [future for future in done if future.exception() is None]
+        if succeeded or not pending:
+            winner = succeeded[0] if succeeded else done.pop()
+            BALANCER.hedged(won=winner is secondary)
+            return winner.result()
+
+
+def in_slot(func, *args, **kwargs):
+    """
+    Run the function on hedge_executor, giving back the slot taken for it once done
+    """
+    try:
+        return func(*args, **kwargs)
+    finally:
+        hedge_slots.release()
+
+
+def execute(host: str, sql: str, params: tuple | None = None):
+    """
+    Run the SQL command on the given host and return the response
+    """
+    pool = get_pool(host)
+    with METRICS.time("backend", host=host), track(host):
+        start = time.perf_counter()
+        with pool.connection() as db:
+            METRICS.observe("phase", time.perf_counter() - start, phase="connect", host=host)
+            if params is not None:
+                with METRICS.time("phase", phase="execute", host=host):
+                    res = STATEMENTS.execute(db, sql, params)
+            else:
+                with db.cursor() as cursor:
+                    with METRICS.time("phase", phase="execute", host=host):
+                        cursor.execute(sql)
+                    with METRICS.time("phase", phase="fetch", host=host):
+                        res = cursor.fetchall()
+
+    with METRICS.time("phase", phase="serialize", host=host):
+        return str(res)
+
+
+def stream(host: str, sql: str, encoder):
+    """
+    Return a generator running the SQL command on the given host and yielding the encoded rows batch by batch, so
+    that the result set is never held in memory as a whole. Streamed results bypass the result cache.
+    """
+    return stream_rows(get_pool(host), host, sql, encoder)
+
+
+def stream_rows(pool: ConnectionPool, host: str, sql: str, encoder):
+    fp = fingerprint(sql)
+    try:
+        with METRICS.time("backend", host=host), track(host):
+            start = time.perf_counter()
+            with pool.connection() as db, db.cursor() as cursor:
+                METRICS.observe("phase", time.perf_counter() - start, phase="connect", host=host)
+                with METRICS.time("phase", phase="execute", host=host):
+                    cursor.execute(sql)
+                yield encoder.header([column[0] for column in cursor.description or []])
+                while True:
+                    with METRICS.time("phase", phase="fetch", host=host):
+                        rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+                    if not rows:
+                        break
+                    with METRICS.time("phase", phase="serialize", host=host):
+                        chunk = encoder.batch(rows)
+                    yield chunk
+                yield encoder.footer()
+    finally:
+        if classify_fingerprint(fp) == WRITE:
+            invalidate(fp)
+
+
+def batch(statements: list[str]) -> list[dict]:
+    """
+    Run a list of statements and report the outcome of each one. Consecutive reads are spread across the slaves
+    and run in parallel, writes are run one after the other on the master node. A write waits for the reads
+    before it, and the reads after it wait for the write, so that they see what it wrote.
+    """
+    with METRICS.time("request", route="batch"):
+        return run_batch(statements)
+
+
+def run_batch(statements: list[str]) -> list[dict]:
+    results = []
+    reads = []
+    for sql in statements:
+        if classify(sql) != WRITE:
+            reads.append(sql)
+            continue
+        results.extend(batch_executor.map(timed, [choose_slave(AUTO_READ_STRATEGY) for _ in reads], reads))
+        reads = []
+        results.append(timed(MANAGER_HOST, sql))
+    results.extend(batch_executor.map(timed, [choose_slave(AUTO_READ_STRATEGY) for _ in reads], reads))
+    return results
+
+
+def timed(host: str, sql: str) -> dict:
+    """
+    Send the request to the given host, reporting its status and duration instead of raising
+    """
+    start = time.perf_counter()
+    try:
+        try:
+            res = {"status": "ok", "result": send(host, sql)}
+        except BackendRemoved:
+            host = MANAGER_HOST if classify(sql) == WRITE else choose_slave(AUTO_READ_STRATEGY)
+            res = {"status": "ok", "result": send(host, sql)}
+    except Exception as e:
+        res = {"status": "error", "error": str(e)}
+    elapsed = time.perf_counter() - start
+    REQUESTS.record(elapsed, error=res["status"] == "error", route="batch", host=host, sql=sql)
+    res["host"] = host
+    res["elapsed_ms"] = elapsed * 1000
+    return res
+
+
+def parse_batch(body: bytes) -> list[str]:
+    """
+    Read the statements of a /batch request, either a JSON list or an object with a "statements" list
+    """
+    try:
+        statements = json.loads(body)
+    except ValueError:
+        raise ValueError("Batch must be a JSON document")
+    if isinstance(statements, dict):
+        statements = statements.get("statements")
+    if not isinstance(statements, list) or not all(isinstance(sql, str) for sql in statements):
+        raise ValueError("Batch must be a list of SQL statements")
+    if len(statements) > BATCH_MAX_STATEMENTS:
+        raise ValueError(f"Batch cannot hold more than {BATCH_MAX_STATEMENTS} statements")
+    for sql in statements:
+        check_statement(sql)
+    return statements
+
+
+def track(host: str):
+    """
+    Feed the latency of queries sent to slaves to the balancer
+    """
+    return BALANCER.track(host) if host in BALANCER else nullcontext()
+
+
+def probe(host: str):
+    """
+    Run a trivial query against the given host, used to keep the balancer statistics fresh
+    """
+    with get_pool(host).connection() as db:
+        with db.cursor() as cursor:
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+
+
+def get_pool(host: str) -> ConnectionPool:
+    pool = POOLS.get(host)
+    if pool is None:
+        raise BackendRemoved(f"Host '{host}' left the backends")
+    return pool
+
+
+def stats() -> dict:
+    """
+    Current backends, state of the connection pools, of the balancer, of the classifier, result and prepared
+    statement caches, of the coalesced reads and of the request log
+    """
+    return {
+        "backends": {
+            "manager": MANAGER_HOST,
+            "slaves": SLAVE_HOSTS,
+            "draining": [host for host, pool in list(POOLS.items()) if pool.draining],
+        },
+        "pools": [pool.stats() for pool in list(POOLS.values())],
+        "balancer": BALANCER.stats(),
+        "classifier": classify_fingerprint.cache_info()._asdict(),
+        "cache": CACHE.stats(),
+        "prepared": STATEMENTS.stats(),
+        "coalesced": FLIGHTS.stats(),
+        "request_log": REQUESTS.stats(),
+    }
+
+
+def metrics() -> dict:
+    """
+    Request counts, error counts and latency percentiles, by route, backend host and phase
+    """
+    return METRICS.snapshot()
+
+
+def start():
+    """
+    Open the minimum number of connections of every pool ahead of the first request, start probing slaves and
+    writing the request log, and watch the backends file for changes
+    """
+    for pool in POOLS.values():
+        warm(pool)
+
+    BALANCER.start_prober(probe, interval=BALANCER_PROBE_INTERVAL)
+    REQUESTS.start()
+    if BACKENDS_FILE:
+        threading.Thread(target=watch_backends, args=(BACKENDS_RELOAD_INTERVAL,), daemon=True,
+                         name="backends-watcher").start()
+
+
+def warm(pool: ConnectionPool):
+    try:
+        pool.fill()
+    except Exception as e:
+        logger.warning(f"Could not warm connection pool for host '{pool.host}': {e}")
+
+
+def apply_backends(manager: str, slaves: list[str]):
+    """
+    Switch to the given backends. New hosts get a pool and start receiving queries right away, while the hosts
+    which left are drained: they get no new queries, and are dropped once the queries they were running
+    completed.
+    """
+    global MANAGER_HOST, SLAVE_HOSTS
+    with _backends_lock:
+        wanted = {manager, *slaves}
+        added = []
+        for host in [manager, *slaves]:
+            pool = POOLS.get(host)
+            if pool is None:
+                POOLS[host] = pool = create_pool(host)
+                added.append(pool)
+            pool.draining = False
+        for host in slaves:
+            BALANCER.add(host)
+
+        if (manager, slaves) != (MANAGER_HOST, SLAVE_HOSTS):
+            logger.info(f"Backends changed to manager '{manager}' and slaves {slaves}")
+        MANAGER_HOST, SLAVE_HOSTS = manager, slaves
+
+        for host in BALANCER.hosts():
+            if host not in slaves:
+                BALANCER.drain(host)
+        for host, pool in list(POOLS.items()):
+            if host not in wanted and not pool.draining:
+                logger.info(f"Draining connection pool for host '{host}'")
+                pool.drain()
+
+    for pool in added:
+        warm(pool)
+
+
+def reap_backends():
+    """
+    Forget the drained hosts without any query left in flight
+    """
+    BALANCER.reap()
+    with _backends_lock:
+        for host, pool in list(POOLS.items()):
+            if pool.draining and host not in BALANCER and pool.in_use() == 0:
+                del POOLS[host]
+                logger.info(f"Host '{host}' drained")
+
+
+def watch_backends(interval: float):
+    mtime = None
+    while True:
+        try:
+            current = os.stat(BACKENDS_FILE).st_mtime_ns
+            if current != mtime:
+                mtime = current
+                apply_backends(*load_backends())
+        except Exception as e:
+            # Keep the current backends until the file is fixed
+            logger.warning(f"Could not reload backends from '{BACKENDS_FILE}': {e}")
+        reap_backends()
+        time.sleep(interval)
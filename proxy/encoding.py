@@ -0,0 +1,102 @@
+import json
+import struct
+
+NDJSON = "application/x-ndjson"
+COLUMNAR = "application/vnd.log8415.columnar"
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return str(value)
+
+
+class NdjsonEncoder:
+    """
+    One JSON document per line: the column names first, then one array per row
+    """
+    mimetype = NDJSON
+
+    def header(self, columns: list[str]) -> bytes:
+        return json.dumps({"columns": columns}).encode() + b"\n"
+
+    def batch(self, rows: list[tuple]) -> bytes:
+        return b"".join(json.dumps(row, default=_json_default).encode() + b"\n" for row in rows)
+
+    def footer(self) -> bytes:
+        return b""
+
+
+class ColumnarEncoder:
+    """
+    Compact binary encoding, laid out column by column, with all integers little-endian.
+
+    The stream starts with the magic b"COL1", the number of columns (u16) and their names (u16 length + UTF-8).
+    Then each batch of rows is a frame: the number of rows (u32), followed for every column by its type (u8),
+    a null bitmap (one bit per row, least significant first) and the non-null values:
+
+    - type 0: int64 each
+    - type 1: float64 each
+    - type 2: UTF-8 text, u32 length + bytes each
+    - type 3: raw bytes, u32 length + bytes each
+
+    A frame of 0 rows ends the stream.
+    """
+    mimetype = COLUMNAR
+
+    INT, FLOAT, TEXT, BYTES = range(4)
+
+    def header(self, columns: list[str]) -> bytes:
+        out = [b"COL1", struct.pack("<H", len(columns))]
+        for name in columns:
+            name = name.encode()
+            out.append(struct.pack("<H", len(name)))
+            out.append(name)
+        return b"".join(out)
+
+    def batch(self, rows: list[tuple]) -> bytes:
+        out = [struct.pack("<I", len(rows))]
+        for values in zip(*rows):
+            out.append(self._column(values))
+        return b"".join(out)
+
+    def footer(self) -> bytes:
+        return struct.pack("<I", 0)
+
+    def _column(self, values: tuple) -> bytes:
+        bitmap = bytearray((len(values) + 7) // 8)
+        present = []
+        for i, value in enumerate(values):
+            if value is None:
+                bitmap[i // 8] |= 1 << (i % 8)
+            else:
+                present.append(value)
+
+        kind = self._kind(present)
+        match kind:
+            case self.INT:
+                data = struct.pack(f"<{len(present)}q", *present)
+            case self.FLOAT:
+                data = struct.pack(f"<{len(present)}d", *present)
+            case self.BYTES:
+                data = b"".join(struct.pack("<I", len(v)) + bytes(v) for v in present)
+            case _:
+                encoded = [str(v).encode() for v in present]
+                data = b"".join(struct.pack("<I", len(v)) + v for v in encoded)
+
+        return struct.pack("<B", kind) + bytes(bitmap) + data
+
+    def _kind(self, values: list) -> int:
+        if all(type(v) is int and INT64_MIN <= v <= INT64_MAX for v in values):
+            return self.INT
+        if all(type(v) in (int, float) for v in values):
+            return self.FLOAT
+        if all(isinstance(v, (bytes, bytearray)) for v in values):
+            return self.BYTES
+        return self.TEXT
+
+
+ENCODERS = {encoder.mimetype: encoder for encoder in (NdjsonEncoder(), ColumnarEncoder())}
@@ -0,0 +1,209 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable
+
+from mysql.connector import connect
+
+logger = logging.getLogger(__name__)
+
+
+class PoolExhaustedError(RuntimeError):
+    pass
+
+
+class ConnectionPool:
+    """
+    Pool of reusable MySQL connections to a single backend host
+    """
+
+    def __init__(self, host: str, min_size: int = 1, max_size: int = 10, idle_timeout: float = 300,
+                 wait_timeout: float = 5, connector: Callable = connect,
+                 reusable_errors: tuple[type[Exception], ...] = (), **connect_args):
+        self.host = host
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.connector = connector
+        # Errors of the statement only, after which the connection is still usable
+        self.reusable_errors = reusable_errors
+        self.connect_args = connect_args
+        # Set once the host left the backends, connections are then closed as soon as they are given back
+        self.draining = False
+
+        # Idle connections along with the time they were returned to the pool
+        self._idle: deque[tuple[object, float]] = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+
+        self._created = 0
+        self._closed = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+
+    def fill(self):
+        """
+        Open connections until the pool holds at least min_size of them
+        """
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            self.release(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a live connection, and give it back once done
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        except self.reusable_errors:
+            self.release(conn)
+            raise
+        except BaseException:
+            # The connection may be broken, or left in the middle of a result set, as when a streamed response is
+            # dropped
+            self.discard(conn)
+            raise
+        self.release(conn)
+
+    def acquire(self):
+        deadline = time.monotonic() + self.wait_timeout
+        waited = False
+        while True:
+            with self._cond:
+                expired = self._evict_idle()
+                conn = None
+                if self._idle:
+                    conn, _ = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolExhaustedError(
+                            f"No connection available to host '{self.host}' after {self.wait_timeout}s")
+                    if not waited:
+                        self._waits += 1
+                        waited = True
+                    self._cond.wait(remaining)
+                    continue
+                self._checkouts += 1
+
+            for old in expired:
+                self._close(old)
+
+            if conn is None:
+                try:
+                    return self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._checkouts -= 1
+                        self._cond.notify()
+                    raise
+
+            if self._is_alive(conn):
+                return conn
+
+            logger.info(f"Dropping dead connection to host '{self.host}'")
+            self.discard(conn)
+            with self._cond:
+                self._checkouts -= 1
+
+    def release(self, conn):
+        if self.draining:
+            self.discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def discard(self, conn):
+        """
+        Close a connection that must not be reused, freeing its slot in the pool
+        """
+        self._close(conn)
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def drain(self):
+        """
+        Close the idle connections, and the ones in use once they are given back, without interrupting them
+        """
+        self.draining = True
+        self.close()
+
+    def in_use(self) -> int:
+        with self._cond:
+            return self._size - len(self._idle)
+
+    def close(self):
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "host": self.host,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "created": self._created,
+                "closed": self._closed,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+            }
+
+    def _evict_idle(self) -> list:
+        # The oldest idle connections sit on the left of the deque
+        expired = []
+        now = time.monotonic()
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            expired.append(conn)
+        return expired
+
+    def _open(self):
+        conn = self.connector(host=self.host, **self.connect_args)
+        with self._cond:
+            self._created += 1
+        return conn
+
+    def _close(self, conn):
+        with self._cond:
+            self._closed += 1
+        try:
+            conn.close()
+        except Exception as e:
+            logger.debug(f"Error while closing connection to host '{self.host}': {e}")
+
+    @staticmethod
+    def _is_alive(conn) -> bool:
+        try:
+            return conn.is_connected()
+        except Exception:
+            return False
@@ -0,0 +1,67 @@
+import threading
+import weakref
+from collections import OrderedDict
+
+
+class StatementCache:
+    """
+    Server-side prepared statements of every connection, kept in a LRU keyed by statement template.
+
+    The MySQL connector only skips preparing a statement again when it is given the very same string object it
+    was prepared with, so each entry keeps the template it was created from.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        # Connections are only ever used by one thread at a time, the lock only guards the mapping itself
+        self._statements: weakref.WeakKeyDictionary[object, OrderedDict[str, tuple[str, object]]] = \
+            weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def execute(self, conn, template: str, params: tuple) -> list:
+        with self._lock:
+            statements = self._statements.setdefault(conn, OrderedDict())
+
+        entry = statements.get(template)
+        if entry is None:
+            cursor = conn.cursor(prepared=True)
+            entry = (template, cursor)
+            statements[template] = entry
+            if len(statements) > self.max_size:
+                _, (_, evicted) = statements.popitem(last=False)
+                evicted.close()
+                with self._lock:
+                    self._evictions += 1
+            with self._lock:
+                self._misses += 1
+        else:
+            statements.move_to_end(template)
+            with self._lock:
+                self._hits += 1
+
+        template, cursor = entry
+        try:
+            cursor.execute(template, params)
+            return cursor.fetchall() if cursor.with_rows else []
+        except Exception:
+            # The statement may not have been prepared, do not keep it around
+            statements.pop(template, None)
+            cursor.close()
+            raise
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "connections": len(self._statements),
+                "statements": sum(len(statements) for statements in self._statements.values()),
+                "max_size": self.max_size,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "hit_rate": self._hits / lookups if lookups else None,
+            }